@@ -17,16 +17,18 @@ import json
 import logging.handlers
 import os
 import socket
+import time
 from itertools import chain
 
 import tensorflow as tf
 import bayou.core.evidence
 from bayou.core.infer import BayesianPredictor
+from bayou.core.latent_index import LatentIndex
 
 TIMEOUT = 10 # seconds
 
 
-def _start_server(save_dir):
+def _start_server(save_dir, index_dir=None):
     logging.debug("entering")
 
     with tf.Session() as sess:
@@ -37,6 +39,7 @@ def _start_server(save_dir):
         print("===================================")
 
         predictor = BayesianPredictor(save_dir, sess) # create a predictor that can generates ASTs from evidence
+        index = LatentIndex(index_dir) if index_dir is not None else None # known ASTs to retrieve from latent space
 
         #
         # Create a socket listening to localhost:8084
@@ -70,7 +73,7 @@ def _start_server(save_dir):
                 evidence = _read_bytes(evidence_size_in_bytes, client_socket).decode("utf-8") # read evidence string
                 logging.debug(evidence)
 
-                asts = _generate_asts(evidence, predictor) # use predictor to generate ASTs JSON from evidence
+                asts = _generate_asts(evidence, predictor, index) # use predictor to generate ASTs JSON from evidence
                 logging.debug(asts)
 
                 _send_string_response(asts, client_socket)
@@ -115,32 +118,52 @@ def okay(js, ast):
     return ev_okay
 
 
-def _generate_asts(evidence_json, predictor):
+def _retrieve_asts(js, predictor, index, k=10):
+    psi = predictor.psi_from_evidence_batch([js], mean=True)
+    asts = [dict(ast) for ast in index.retrieve(psi, k)]
+    for ast in asts:
+        ast['count'] = 0
+    return asts
+
+
+def _generate_asts(evidence_json, predictor, index=None):
     logging.debug("entering")
     js = json.loads(evidence_json) # parse evidence as a JSON string
 
+    #
+    # In "retrieve" mode, return the known ASTs nearest to the evidence in latent space instead of sampling.
+    #
+    if index is not None and js.get('mode') == 'retrieve':
+        asts = [ast for ast in _retrieve_asts(js, predictor, index) if okay(js, ast)]
+        logging.debug("exiting")
+        return json.dumps({'evidences': js, 'asts': asts}, indent=2)
+
     #
     # Generate ASTs from evidence.
     #
     # Perform up to 100 inference operations from evidence. Track each inferred ast by the number of times it has
     # been returned by the inference operation. If the most inferred ast has ever been seen 10 more times than
-    # the second most inferred ast, stop inferring asts.
+    # the second most inferred ast, or if TIMEOUT seconds have passed, stop inferring asts.
     #
     asts, counts = [], [] # a list of inferred asts and the number of times each has been inferred (by common index)
                           # in descending order number of times inferred.
+    start = time.time()
     for i in range(100):
+        if time.time() - start > TIMEOUT:
+            logging.debug("sampling timed out")
+            break
         try:
             ast = predictor.infer(js)
             ast['calls'] = list(set(predictor.calls_in_last_ast))
 
             if ast in asts: # if we have seen this ast before, increment its count
 
-                index = asts.index(ast)
-                counts[index] += 1
+                j = asts.index(ast)
+                counts[j] += 1
 
-                if index != 0 and counts[index] > counts[index-1]: # adjust to preserve sorted order if needed
-                    asts[index], asts[index-1] = asts[index-1], asts[index]
-                    counts[index], counts[index-1] = counts[index-1], counts[index]
+                if j != 0 and counts[j] > counts[j-1]: # adjust to preserve sorted order if needed
+                    asts[j], asts[j-1] = asts[j-1], asts[j]
+                    counts[j], counts[j-1] = counts[j-1], counts[j]
 
             else: # new ast observed, make a new entry for it
                 asts.append(ast)
@@ -166,6 +189,12 @@ def _generate_asts(evidence_json, predictor):
     # Return the top 10 ok asts.
     #
     asts = [ast for ast in asts[:10] if okay(js, ast)]
+
+    #
+    # Fall back to the nearest known ASTs if sampling produced none.
+    #
+    if index is not None and len(asts) == 0:
+        asts = [ast for ast in _retrieve_asts(js, predictor, index) if okay(js, ast)]
     logging.debug("exiting")
     return json.dumps({'evidences': js, 'asts': asts}, indent=2)
 
@@ -176,6 +205,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--save_dir', type=str, required=True,help='model directory to laod from')
     parser.add_argument('--logs_dir', type=str, required=False, help='the directory to store log information')
+    parser.add_argument('--index_dir', type=str, required=False,
+                        help='latent index (see bayou.core.latent_index) to retrieve known ASTs from')
     args = parser.parse_args()
 
     if args.logs_dir is None:
@@ -191,4 +222,4 @@ if __name__ == '__main__':
                         handlers=[logging.handlers.RotatingFileHandler(logpath, maxBytes=100000000, backupCount=9)])
 
     # Start processing requests.
-    _start_server(args.save_dir)
+    _start_server(args.save_dir, args.index_dir)
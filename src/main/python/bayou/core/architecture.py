@@ -19,15 +19,17 @@ from itertools import chain
 class BayesianEncoder(object):
     def __init__(self, config):
 
+        # the batch dimension is dynamic so that inference can encode evidences in bulk
         self.inputs = [ev.placeholder(config) for ev in config.evidence]
+        batch_size = tf.shape(self.inputs[0])[0]
         exists = [ev.exists(i) for ev, i in zip(config.evidence, self.inputs)]
-        zeros = tf.zeros([config.batch_size, config.latent_size], dtype=tf.float32)
+        zeros = tf.zeros([batch_size, config.latent_size], dtype=tf.float32)
 
         # Compute the denominator used for mean and covariance
         for ev in config.evidence:
             ev.init_sigma(config)
-        d = [tf.where(exist, tf.tile([1. / tf.square(ev.sigma)], [config.batch_size]),
-                      tf.zeros(config.batch_size)) for ev, exist in zip(config.evidence, exists)]
+        d = [tf.where(exist, tf.tile([1. / tf.square(ev.sigma)], [batch_size]),
+                      tf.zeros([batch_size])) for ev, exist in zip(config.evidence, exists)]
         d = 1. + tf.reduce_sum(tf.stack(d), axis=0)
         denom = tf.tile(tf.reshape(d, [-1, 1]), [1, config.latent_size])
 
@@ -50,22 +52,52 @@ class BayesianEncoder(object):
 
         # Compute the covariance of Psi
         with tf.variable_scope('covariance'):
-            I = tf.ones([config.batch_size, config.latent_size], dtype=tf.float32)
+            I = tf.ones([batch_size, config.latent_size], dtype=tf.float32)
             self.psi_covariance = I / denom
 
 
+class TreeCell(tf.nn.rnn_cell.RNNCell):
+    """Runs cell1 on inputs along a CHILD_EDGE and cell2 on inputs along a SIBLING_EDGE. The edge is
+    given as the last feature of each input (1 for CHILD_EDGE, 0 for SIBLING_EDGE)."""
+
+    def __init__(self, cell1, cell2):
+        super(TreeCell, self).__init__()
+        self.cell1 = cell1
+        self.cell2 = cell2
+
+    @property
+    def state_size(self):
+        return self.cell1.state_size
+
+    @property
+    def output_size(self):
+        return self.cell1.output_size
+
+    def __call__(self, inputs, state, scope=None):
+        inp, edge = inputs[:, :-1], tf.cast(inputs[:, -1], tf.bool)
+        with tf.variable_scope('cell1'):  # handles CHILD_EDGE
+            output1, state1 = self.cell1(inp, state)
+        with tf.variable_scope('cell2'):  # handles SIBLING_EDGE
+            output2, state2 = self.cell2(inp, state)
+        output = tf.where(edge, output1, output2)
+        state = tf.where(edge, state1, state2)
+        return output, state
+
+
 class BayesianDecoder(object):
     def __init__(self, config, initial_state, infer=False):
 
         self.cell1 = tf.nn.rnn_cell.GRUCell(config.decoder.units)
         self.cell2 = tf.nn.rnn_cell.GRUCell(config.decoder.units)
 
-        # placeholders
+        # placeholders: each row is a path of the given length, padded up to the longest path in the batch
         self.initial_state = initial_state
-        self.nodes = [tf.placeholder(tf.int32, [config.batch_size], name='node{0}'.format(i))
-                      for i in range(config.decoder.max_ast_depth)]
-        self.edges = [tf.placeholder(tf.bool, [config.batch_size], name='edge{0}'.format(i))
-                      for i in range(config.decoder.max_ast_depth)]
+        self.nodes = tf.placeholder(tf.int32, [None, None], name='nodes')
+        self.edges = tf.placeholder(tf.bool, [None, None], name='edges')
+        self.lengths = tf.placeholder(tf.int32, [None], name='lengths')
+
+        # mask of positions that have a target (the node following it in the path)
+        self.mask = tf.sequence_mask(self.lengths - 1, tf.shape(self.nodes)[1], dtype=tf.float32)
 
         # projection matrices for output
         self.projection_w = tf.get_variable('projection_w', [self.cell1.output_size,
@@ -75,33 +107,10 @@ class BayesianDecoder(object):
         # setup embedding
         with tf.variable_scope('decoder'):
             emb = tf.get_variable('emb', [config.decoder.vocab_size, config.decoder.units])
+            emb_inp = tf.nn.embedding_lookup(emb, self.nodes)
+            inp = tf.concat([emb_inp, tf.expand_dims(tf.cast(self.edges, tf.float32), 2)], axis=2)
 
-            def loop_fn(prev, _):
-                prev = tf.nn.xw_plus_b(prev, self.projection_w, self.projection_b)
-                prev_symbol = tf.argmax(prev, 1)
-                return tf.nn.embedding_lookup(emb, prev_symbol)
-
-            loop_function = loop_fn if infer else None
-            emb_inp = (tf.nn.embedding_lookup(emb, i) for i in self.nodes)
-
-            # the decoder (modified from tensorflow's seq2seq library to fit tree RNNs)
-            # TODO: update with dynamic decoder (being implemented in tf) once it is released
-            with tf.variable_scope('rnn'):
-                self.state = self.initial_state
-                self.outputs = []
-                prev = None
-                for i, inp in enumerate(emb_inp):
-                    if loop_function is not None and prev is not None:
-                        with tf.variable_scope('loop_function', reuse=True):
-                            inp = loop_function(prev, i)
-                    if i > 0:
-                        tf.get_variable_scope().reuse_variables()
-                    with tf.variable_scope('cell1'):  # handles CHILD_EDGE
-                        output1, state1 = self.cell1(inp, self.state)
-                    with tf.variable_scope('cell2'):  # handles SIBLING_EDGE
-                        output2, state2 = self.cell2(inp, self.state)
-                    output = tf.where(self.edges[i], output1, output2)
-                    self.state = tf.where(self.edges[i], state1, state2)
-                    self.outputs.append(output)
-                    if loop_function is not None:
-                        prev = output
+            # the decoder, unrolled dynamically only up to the longest path in the batch
+            cell = TreeCell(self.cell1, self.cell2)
+            self.outputs, self.state = tf.nn.dynamic_rnn(cell, inp, sequence_length=self.lengths,
+                                                         initial_state=self.initial_state, scope='rnn')
@@ -0,0 +1,134 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import numpy as np
+import tensorflow as tf
+
+import json
+import os
+import queue
+import threading
+
+CHECKPOINT = 'model.ckpt'
+BEST_CHECKPOINT = 'best.ckpt'
+
+
+def read_state(checkpoint_path):
+    """Return the training state saved with a checkpoint, or None if there is none (older checkpoints)"""
+    try:
+        with open(checkpoint_path + '.json') as f:
+            state = json.load(f)
+    except IOError:
+        return None
+    kind, key, pos, has_gauss, cached_gaussian = state['shuffle']
+    state['shuffle'] = (kind, np.array(key, dtype=np.uint32), pos, has_gauss, cached_gaussian)
+    return state
+
+
+def write_state(checkpoint_path, state):
+    kind, key, pos, has_gauss, cached_gaussian = state['shuffle']
+    state = dict(state, shuffle=[kind, key.tolist(), int(pos), int(has_gauss), float(cached_gaussian)])
+    with open(checkpoint_path + '.json', 'w') as f:
+        json.dump(state, f)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints from a background thread, keeping the last few plus the best one by loss.
+
+    The values of the variables are fetched (between training steps) in the training thread, and written
+    to disk by a separate session holding a copy of them, so training only waits for the fetch."""
+
+    def __init__(self, save_dir, variables, keep=5, best_loss=np.inf):
+        self.save_dir = save_dir
+        self.variables = variables
+        self.best_loss = best_loss  # of the best checkpoint already written, when resuming
+        self.error = None
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            copies, self.placeholders, assigns = [], [], []
+            for var in variables:
+                dtype = var.dtype.base_dtype
+                copy = tf.Variable(tf.zeros(var.get_shape(), dtype=dtype), trainable=False)
+                placeholder = tf.placeholder(dtype, var.get_shape())
+                copies.append(copy)
+                self.placeholders.append(placeholder)
+                assigns.append(tf.assign(copy, placeholder))
+            self.assign = tf.group(*assigns)
+
+            # save the copies under the names of the original variables, to restore them in the training graph
+            var_list = {var.op.name: copy for var, copy in zip(variables, copies)}
+            self.saver = tf.train.Saver(var_list, max_to_keep=keep)
+            self.best_saver = tf.train.Saver(var_list, max_to_keep=1)
+        self.sess = tf.Session(graph=self.graph)
+
+        # keep rotating the checkpoints already in save_dir (e.g., of the run being resumed), which a new saver
+        # does not know of: it would neither delete them nor, in remove_stale_states, keep their states
+        ckpt = tf.train.get_checkpoint_state(save_dir)
+        if ckpt is not None:
+            self.saver.recover_last_checkpoints(list(ckpt.all_model_checkpoint_paths))
+
+        self.requests = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, sess, step, state, loss=None):
+        """Snapshot the variables in sess and queue them to be written, with the training state and (optionally)
+        the loss used to keep the best checkpoint. Waits only if the previous checkpoint is still being written."""
+        if self.error is not None:
+            raise self.error
+        values = sess.run(self.variables)
+        self.requests.put((values, step, state, loss))
+
+    def close(self):
+        """Wait for the pending checkpoints to be written"""
+        self.requests.put(None)
+        self.thread.join()
+        self.sess.close()
+        if self.error is not None:
+            raise self.error
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                self.write(*request)
+            except Exception as e:
+                self.error = e
+
+    def write(self, values, step, state, loss):
+        self.sess.run(self.assign, dict(zip(self.placeholders, values)))
+
+        path = self.saver.save(self.sess, os.path.join(self.save_dir, CHECKPOINT), global_step=step)
+        write_state(path, state)
+        self.remove_stale_states()
+
+        if loss is not None and loss < self.best_loss:
+            self.best_loss = loss
+            path = self.best_saver.save(self.sess, os.path.join(self.save_dir, BEST_CHECKPOINT),
+                                        latest_filename='best_checkpoint')
+            write_state(path, dict(state, loss=loss))
+
+    def remove_stale_states(self):
+        # the saver deletes the checkpoints it no longer keeps, but not the states written along with them
+        keep = set(os.path.basename(path) + '.json' for path in self.saver.last_checkpoints)
+        for name in os.listdir(self.save_dir):
+            if name.startswith(CHECKPOINT + '-') and name.endswith('.json') and name not in keep:
+                os.remove(os.path.join(self.save_dir, name))
@@ -0,0 +1,287 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import numpy as np
+import argparse
+import json
+import os
+import re
+import uuid
+
+HELP = """Use this to convert a data file in the usual {"programs": [...]} JSON format (or JSON-lines format) into a
+columnar corpus directory, or back. A corpus stores the strings of all programs (calls, evidences, javadoc words)
+once in a string table, and the ASTs, evidences and javadocs as memory-mapped arrays of string ids, so that any
+program can be read without parsing the others. Other fields are kept as JSON. A corpus directory can be given
+instead of a data file to every tool that reads programs with bayou.core.programs.read_programs.
+The direction of the conversion is given by the input: a corpus directory is converted to a data file."""
+
+CORPUS_VERSION = 1
+# metadata: version, id (new every time the corpus is written), number of programs and kind of each column
+CORPUS = 'corpus.json'
+STRINGS = 'strings.json'  # string table
+EXTRA = 'extra'  # column with the other fields of each program, as JSON
+
+# ASTs are stored in preorder: an API call is the (non-negative) id of its call string, and any other node is
+# the marker of its type followed by the nodes in each of its fields, each list terminated by END
+END = -1
+NODE_TYPES = ['DSubTree', 'DBranch', 'DExcept', 'DLoop']
+NODE_FIELDS = {'DSubTree': ['_nodes'],
+               'DBranch': ['_cond', '_then', '_else'],
+               'DExcept': ['_try', '_catch'],
+               'DLoop': ['_cond', '_body']}
+
+# kinds of columns: an AST, a list of strings (evidences), and a text stored as the ids of its words (javadoc)
+AST, LIST, TOKENS = 'ast', 'list', 'tokens'
+COLUMN_NAME = re.compile(r'^\w+$')
+
+
+def is_corpus(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, CORPUS))
+
+
+def corpus_key(path):
+    """A key that changes whenever the corpus is written again, even in place: its id, and the size and modification
+    time of each of its files"""
+    with open(os.path.join(path, CORPUS)) as f:
+        meta = json.load(f)
+    files = [CORPUS, STRINGS] + [name + ext for name in sorted(meta['columns'])
+                                 for ext in ['.data', '.offsets', '.present']]
+    stats = [os.stat(os.path.join(path, name)) for name in files]
+    return [os.path.abspath(path), meta.get('id')] + [[name, st.st_size, st.st_mtime] for name, st in zip(files, stats)]
+
+
+def _encode_ast(js, intern, out):
+    node = js['node']
+    if node == 'DAPICall':
+        if len(js) != 2:
+            raise ValueError('Unexpected fields in {}'.format(node))
+        out.append(intern(js['_call']))
+        return
+    if node not in NODE_FIELDS or len(js) != len(NODE_FIELDS[node]) + 1:
+        raise ValueError('Cannot store node {}'.format(node))
+    out.append(END - 1 - NODE_TYPES.index(node))
+    for field in NODE_FIELDS[node]:
+        for child in js[field]:
+            _encode_ast(child, intern, out)
+        out.append(END)
+
+
+def _decode_ast(tokens, strings):
+    pos = 0
+
+    def decode():
+        nonlocal pos
+        token = tokens[pos]
+        pos += 1
+        if token >= 0:
+            return {'node': 'DAPICall', '_call': strings[token]}
+        node = NODE_TYPES[END - 1 - token]
+        js = {'node': node}
+        for field in NODE_FIELDS[node]:
+            children = []
+            while tokens[pos] != END:
+                children.append(decode())
+            pos += 1
+            js[field] = children
+        return js
+    return decode()
+
+
+class _ColumnWriter(object):
+    """A column being written: the data of all programs concatenated, the offset at which each program starts (and
+    the end), and whether each program has the column. Programs before the column was first seen do not have it."""
+
+    def __init__(self, path, name, kind, count, dtype):
+        self.kind, self.dtype = kind, dtype
+        self.data = open(os.path.join(path, name + '.data'), 'wb')
+        self.offsets = open(os.path.join(path, name + '.offsets'), 'wb')
+        self.present = open(os.path.join(path, name + '.present'), 'wb')
+        self.end = 0
+        self.offsets.write(np.zeros(count + 1, dtype=np.int64).tobytes())
+        self.present.write(np.zeros(count, dtype=np.uint8).tobytes())
+
+    def write(self, values=None):
+        if values is not None:
+            data = values if self.dtype is None else np.array(values, dtype=self.dtype).tobytes()
+            self.data.write(data)
+            self.end += len(values)
+        self.offsets.write(np.int64(self.end).tobytes())
+        self.present.write(np.uint8(values is not None).tobytes())
+
+    def close(self):
+        for f in [self.data, self.offsets, self.present]:
+            f.close()
+
+
+class CorpusWriter(object):
+    """Writes programs one at a time to a corpus directory, holding only the string table in memory. The directory
+    is a corpus only once close has written its metadata: not while it is being written (even over an older corpus),
+    nor if writing fails (see abort, which the with statement calls on an exception)."""
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        if os.path.exists(os.path.join(path, CORPUS)):
+            os.remove(os.path.join(path, CORPUS))
+        self.path = path
+        self.strings = {}
+        self.columns = {EXTRA: _ColumnWriter(path, EXTRA, 'json', 0, None)}
+        self.count = 0
+
+    def intern(self, string):
+        return self.strings.setdefault(string, len(self.strings))
+
+    def column(self, name, kind):
+        if name not in self.columns:
+            self.columns[name] = _ColumnWriter(self.path, name, kind, self.count, np.int32)
+        column = self.columns[name]
+        return column if column.kind == kind else None
+
+    def write(self, program):
+        values, extra = {}, {}
+        for name, value in program.items():
+            column = None
+            if COLUMN_NAME.match(name) and name != EXTRA:
+                if name == 'ast' and isinstance(value, dict):
+                    column = self.column(name, AST)
+                    tokens = []
+                    try:
+                        _encode_ast(value, self.intern, tokens)
+                    except (KeyError, TypeError, ValueError):
+                        column = None
+                elif isinstance(value, list) and all(isinstance(v, str) for v in value):
+                    column = self.column(name, LIST)
+                    tokens = [self.intern(v) for v in value]
+                elif name.startswith('javadoc') and isinstance(value, str):
+                    # NOTE: the words of the javadoc are kept, not the whitespace between them
+                    column = self.column(name, TOKENS)
+                    tokens = [self.intern(v) for v in value.split()]
+            if column is not None:
+                values[name] = tokens
+            else:
+                extra[name] = value
+
+        for name, column in self.columns.items():
+            if name == EXTRA:
+                column.write(json.dumps(extra, separators=(',', ':')).encode('utf-8') if extra else None)
+            else:
+                column.write(values.get(name))
+        self.count += 1
+
+    def close(self):
+        for column in self.columns.values():
+            column.close()
+        strings = [None] * len(self.strings)
+        for string, i in self.strings.items():
+            strings[i] = string
+        with open(os.path.join(self.path, STRINGS), 'w') as f:
+            json.dump(strings, f)
+        with open(os.path.join(self.path, CORPUS), 'w') as f:
+            json.dump({'version': CORPUS_VERSION, 'id': uuid.uuid4().hex, 'programs': self.count,
+                       'columns': {name: column.kind for name, column in self.columns.items()}}, f, indent=2)
+
+    def abort(self):
+        for column in self.columns.values():
+            column.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def _map(filename, dtype, count=None):
+    # memory-map a file (which may be empty) as an array
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', shape=count)
+
+
+class Corpus(object):
+    """A corpus directory, with random access to its programs by index"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, CORPUS)) as f:
+            meta = json.load(f)
+        assert meta['version'] == CORPUS_VERSION, 'Unsupported corpus version in {}'.format(path)
+        with open(os.path.join(path, STRINGS)) as f:
+            self.strings = json.load(f)
+        self.num_programs = meta['programs']
+        self.kinds = meta['columns']
+        self.columns = {}
+        for name, kind in self.kinds.items():
+            prefix = os.path.join(path, name)
+            self.columns[name] = (_map(prefix + '.data', np.uint8 if name == EXTRA else np.int32),
+                                  _map(prefix + '.offsets', np.int64, self.num_programs + 1),
+                                  _map(prefix + '.present', np.uint8, self.num_programs))
+
+    def __len__(self):
+        return self.num_programs
+
+    def __iter__(self):
+        for i in range(self.num_programs):
+            yield self[i]
+
+    def ids(self, name, i):
+        """The string ids (or AST tokens) of a column of a program, or None if it does not have the column"""
+        data, offsets, present = self.columns[name]
+        if not present[i]:
+            return None
+        return data[offsets[i]:offsets[i + 1]]
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.num_programs:
+            raise IndexError('Program {} not in corpus'.format(i))
+        program = {}
+        for name, kind in self.kinds.items():
+            ids = self.ids(name, i)
+            if ids is None:
+                continue
+            if name == EXTRA:
+                program.update(json.loads(ids.tobytes().decode('utf-8')))
+            elif kind == AST:
+                program[name] = _decode_ast(ids.tolist(), self.strings)
+            elif kind == LIST:
+                program[name] = [self.strings[j] for j in ids.tolist()]
+            else:
+                program[name] = ' '.join(self.strings[j] for j in ids.tolist())
+        return program
+
+
+def convert(clargs):
+    from bayou.core.programs import read_programs, ProgramWriter  # which imports this module
+    if is_corpus(clargs.input_file[0]):
+        writer = ProgramWriter(clargs.output[0])
+    else:
+        writer = CorpusWriter(clargs.output[0])
+    with writer:
+        for i, program in enumerate(read_programs(clargs.input_file[0])):
+            writer.write(program)
+            print('Converted {} programs'.format(i + 1), end='\r')
+    print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=HELP)
+    parser.add_argument('input_file', type=str, nargs=1,
+                        help='input data file (JSON, or JSON-lines if it ends with .jsonl) or corpus directory')
+    parser.add_argument('output', type=str, nargs=1,
+                        help='output corpus directory, or data file if the input is a corpus')
+    clargs = parser.parse_args()
+    convert(clargs)
@@ -13,142 +13,358 @@
 # limitations under the License.
 
 from __future__ import print_function
-import json
 import numpy as np
-import random
+import argparse
+import glob
+import hashlib
+import json
+import os
+import queue
+import threading
 from collections import Counter
 
-from bayou.core.utils import C0, CHILD_EDGE, SIBLING_EDGE
+from bayou.core.corpus import is_corpus, corpus_key
+from bayou.core.evidence import Javadoc
+from bayou.core.utils import C0, CHILD_EDGE, SIBLING_EDGE, read_programs, read_config, chunks, parallel_map, \
+    ast_paths, pad_paths
+
+CHUNK_SIZE = 1000  # number of programs wrangled at a time (by a worker) while reading
+CACHE_VERSION = 3  # bump whenever the format of the preprocessed cache changes
+VALIDATION_SEED = 0  # the programs held out for validation must not change between runs
+
+HELP = """Use this to preprocess a data file into a cache of numpy arrays that can be memory-mapped during training.
+Provide the same options (and the same --cache_dir) to train.py to use the cache."""
 
 
 class Reader():
     def __init__(self, clargs, config):
         self.config = config
+        self.prefetch = clargs.prefetch
+        self.batches = None
+
+        # read the data, either from the preprocessed cache (memory-mapped) or from the data file
+        new_vocab = clargs.continue_from is None
+        if clargs.cache_dir is not None:
+            cache = os.path.join(clargs.cache_dir, self.cache_key(clargs))
+            if not os.path.exists(cache):
+                self.write_cache(cache, *self.preprocess(clargs.input_file[0], new_vocab, clargs.num_workers))
+            print('Loading preprocessed data from {}...'.format(cache))
+            data = self.read_cache(cache, new_vocab)
+        else:
+            data = self.preprocess(clargs.input_file[0], new_vocab, clargs.num_workers)
+        self.inputs, self.nodes, self.edges, self.targets, self.lengths, programs = data
+
+        # hold out data for validation, either from a separate file or a (fixed) random fraction of the programs
+        self.train_idx = np.arange(len(self.nodes))
+        self.valid = None
+        if clargs.validation_file is not None:
+            print('Reading validation data...')
+            self.valid = self.preprocess(clargs.validation_file, False, clargs.num_workers)[:-1]
+        elif clargs.validation_split > 0:
+            held_out = np.random.RandomState(VALIDATION_SEED).rand(len(programs)) < clargs.validation_split
+            held_out = np.repeat(held_out, programs)
+            self.train_idx, valid_idx = np.where(~held_out)[0], np.where(held_out)[0]
+            self.valid = [ev_data[valid_idx] for ev_data in self.inputs], self.nodes[valid_idx], \
+                self.edges[valid_idx], self.targets[valid_idx], self.lengths[valid_idx]
+        if self.valid is not None:
+            print('{:8d} data points held out for validation'.format(len(self.valid[1])))
+
+        # align with number of batches. With data-parallel training, the batches of every epoch are
+        # sharded between the replicas, and num_batches is the number of batches in each shard.
+        self.total_batches = int(len(self.train_idx) / config.batch_size)
+        assert self.total_batches >= clargs.num_replicas > 0, 'Not enough data'
+        self.num_shards, self.shard = clargs.num_replicas, clargs.task_index
+        config.num_batches = self.total_batches // self.num_shards
 
-        # read the raw evidences and targets
+        # all replicas use the same seed, so that they agree on the batches of every epoch
+        self.rng = np.random.RandomState(clargs.seed)
+
+        # reset batches
+        self.reset_batches()
+
+    def preprocess(self, filename, new_vocab, num_workers=1):
+        """Read and wrangle the data file into numpy arrays of inputs, nodes, (bit-packed) edges, targets
+        and path lengths, and the number of paths (data points) of each program"""
+        config = self.config
+
+        # stream the programs in chunks to the workers, and merge the wrangled chunks in order so that
+        # the result does not depend on the number of workers. Only the (compact) numpy arrays are held
+        # in memory for the whole data set.
         print('Reading data file...')
-        raw_evidences, raw_targets = self.read_data(clargs.input_file[0])
-        raw_evidences = [[raw_evidence[i] for raw_evidence in raw_evidences] for i, ev in
-                         enumerate(config.evidence)]
-
-        # align with number of batches
-        config.num_batches = int(len(raw_targets) / config.batch_size)
-        assert config.num_batches > 0, 'Not enough data'
-        sz = config.num_batches * config.batch_size
-        for i in range(len(raw_evidences)):
-            raw_evidences[i] = raw_evidences[i][:sz]
-        raw_targets = raw_targets[:sz]
+        nodes, edges, lengths, programs, inputs = [], [], [], [], [[] for _ in config.evidence]
+        counts, ids = Counter(), {}  # temporary ids in order of appearance, 0 is padding
+        ignored, done = 0, 0
+        for chunk in parallel_map(_wrangle_chunk, chunks(read_programs(filename), CHUNK_SIZE), num_workers,
+                                  initializer=_init_worker, initargs=(self,)):
+            chunk_inputs, n, e, l, p, chars, chunk_counts, chunk_ignored, chunk_done = chunk
+            ignored, done = ignored + chunk_ignored, done + chunk_done
+            print('{:8d} programs in training data'.format(done), end='\r')
+            if len(n) == 0:
+                continue
+            remap = np.array([0] + [ids.setdefault(c, len(ids) + 1) for c in chars], dtype=np.int32)
+            for i, ev_data in enumerate(chunk_inputs):
+                inputs[i].append(ev_data)
+            nodes.append(remap[n])
+            edges.append(e)
+            lengths.append(l)
+            programs.append(p)
+            counts.update(chunk_counts)
+        print('\n{:8d} programs ignored by given config'.format(ignored))
+        assert len(nodes) > 0, 'Not enough data'
+        nodes, edges, lengths = np.concatenate(nodes), np.concatenate(edges), np.concatenate(lengths)
+        programs = np.concatenate(programs)
+        inputs = [np.concatenate(ev_data) for ev_data in inputs]
 
         # setup input and target chars/vocab
-        if clargs.continue_from is None:
-            counts = Counter([n for path in raw_targets for (n, _) in path])
+        if new_vocab:
             counts[C0] = 1
             config.decoder.chars = sorted(counts.keys(), key=lambda w: counts[w], reverse=True)
             config.decoder.vocab = dict(zip(config.decoder.chars, range(len(config.decoder.chars))))
             config.decoder.vocab_size = len(config.decoder.vocab)
 
-        # wrangle the evidences and targets into numpy arrays
-        self.inputs = [ev.wrangle(data) for ev, data in zip(config.evidence, raw_evidences)]
-        self.nodes = np.zeros((sz, config.decoder.max_ast_depth), dtype=np.int32)
-        self.edges = np.zeros((sz, config.decoder.max_ast_depth), dtype=np.bool)
-        self.targets = np.zeros((sz, config.decoder.max_ast_depth), dtype=np.int32)
-        for i, path in enumerate(raw_targets):
-            self.nodes[i, :len(path)] = list(map(config.decoder.vocab.get, [p[0] for p in path]))
-            self.edges[i, :len(path)] = [p[1] == CHILD_EDGE for p in path]
-            self.targets[i, :len(path)-1] = self.nodes[i, 1:len(path)]  # shifted left by one
-
-        # split into batches
-        self.inputs = [np.split(ev_data, config.num_batches, axis=0) for ev_data in self.inputs]
-        self.nodes = np.split(self.nodes, config.num_batches, axis=0)
-        self.edges = np.split(self.edges, config.num_batches, axis=0)
-        self.targets = np.split(self.targets, config.num_batches, axis=0)
+        # map the temporary ids to the vocab (ignoring the data points with nodes not in an existing vocab),
+        # and shift the nodes left by one for the targets
+        lookup = np.zeros(len(ids) + 1, dtype=np.int32)
+        for c, i in ids.items():
+            lookup[i] = config.decoder.vocab.get(c, -1)
+        nodes = lookup[nodes]
+        known = np.all(nodes >= 0, axis=1)
+        if not np.all(known):
+            print('{:8d} data points ignored with nodes not in the vocab'.format(np.sum(~known)))
+            programs = np.bincount(np.repeat(np.arange(len(programs)), programs)[known], minlength=len(programs))
+            programs = programs[programs > 0]
+            inputs = [ev_data[known] for ev_data in inputs]
+            nodes, edges, lengths = nodes[known], edges[known], lengths[known]
+        targets = np.zeros_like(nodes)
+        targets[:, :-1] = nodes[:, 1:]
 
-        # reset batches
-        self.reset_batches()
+        return inputs, nodes, edges, targets, lengths, programs.astype(np.int32)
+
+    def wrangle_chunk(self, programs):
+        """Wrangle a chunk of programs into arrays, with nodes numbered by a vocab local to the chunk"""
+        config = self.config
+        chars = {}
+        evidences, targets, ignored, done = self.read_data(programs, lambda c: chars.setdefault(c, len(chars) + 1))
+        if len(targets) == 0:
+            return [], np.zeros((0, 0), dtype=np.int32), None, None, None, [], Counter(), ignored, done
+
+        # wrangle the evidences once per program, and repeat them for each of its paths
+        repeats = [len(l) for _, _, l in targets]
+        inputs = [np.repeat(ev.wrangle([evidence[i] for evidence in evidences]), repeats, axis=0)
+                  for i, ev in enumerate(config.evidence)]
+
+        n, e, l = pad_paths(*zip(*targets), max_depth=config.decoder.max_ast_depth)
+        counts = Counter(dict(zip(chars, np.bincount(n.ravel(), minlength=len(chars) + 1)[1:].tolist())))
+        p = np.array(repeats, dtype=np.int32)
+
+        return inputs, n, np.packbits(e, axis=1), l, p, list(chars), counts, ignored, done
+
+    def cache_key(self, clargs):
+        """Hash of everything the preprocessed data depends on: data file, embeddings, config and vocab"""
+        def stat(filename):
+            if is_corpus(filename):  # the directory itself may not change when the corpus is written again
+                return corpus_key(filename)
+            st = os.stat(filename)
+            return [os.path.abspath(filename), st.st_size, st.st_mtime]
+
+        js = {'version': CACHE_VERSION,
+              'input_file': stat(clargs.input_file[0]),
+              'embeddings': [stat(f) for f in sorted(glob.glob(os.path.join(clargs.save, 'embed_*', '*')))],
+              'evidence': [ev.dump_config() for ev in self.config.evidence],
+              'max_ast_depth': self.config.decoder.max_ast_depth,
+              'chars': self.config.decoder.chars if clargs.continue_from is not None else None}
+        for ev, ev_js in zip(self.config.evidence, js['evidence']):
+            if isinstance(ev, Javadoc):
+                ev_js['max_length'] = ev.max_sentence_length
+        return hashlib.sha1(json.dumps(js, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def write_cache(self, cache, inputs, nodes, edges, targets, lengths, programs):
+        print('Writing preprocessed data to {}...'.format(cache))
+        tmp = cache + '.tmp'
+        if not os.path.exists(tmp):
+            os.makedirs(tmp)
+        for i, ev_data in enumerate(inputs):
+            np.save(os.path.join(tmp, 'input{}.npy'.format(i)), ev_data)
+        np.save(os.path.join(tmp, 'nodes.npy'), nodes)
+        np.save(os.path.join(tmp, 'edges.npy'), edges)
+        np.save(os.path.join(tmp, 'targets.npy'), targets)
+        np.save(os.path.join(tmp, 'lengths.npy'), lengths)
+        np.save(os.path.join(tmp, 'programs.npy'), programs)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'version': CACHE_VERSION,
+                       'num_data_points': len(nodes),
+                       'chars': self.config.decoder.chars}, f)
+        os.rename(tmp, cache)  # only complete caches are ever visible
 
-    def get_ast_paths(self, js, idx=0):
-        cons_calls = []
-        i = idx
-        while i < len(js):
-            if js[i]['node'] == 'DAPICall':
-                cons_calls.append((js[i]['_call'], SIBLING_EDGE))
-            else:
-                break
-            i += 1
-        if i == len(js):
-            cons_calls.append(('STOP', SIBLING_EDGE))
-            return [cons_calls]
-        node_type = js[i]['node']
-
-        if node_type == 'DBranch':
-            pC = self.get_ast_paths(js[i]['_cond'])  # will have at most 1 "path"
-            assert len(pC) <= 1
-            p1 = self.get_ast_paths(js[i]['_then'])
-            p2 = self.get_ast_paths(js[i]['_else'])
-            p = [p1[0] + path for path in p2] + p1[1:]
-            pv = [cons_calls + [('DBranch', CHILD_EDGE)] + pC[0] + path for path in p]
-            p = self.get_ast_paths(js, i+1)
-            ph = [cons_calls + [('DBranch', SIBLING_EDGE)] + path for path in p]
-            return ph + pv
-
-        if node_type == 'DExcept':
-            p1 = self.get_ast_paths(js[i]['_try'])
-            p2 = self.get_ast_paths(js[i]['_catch'])
-            p = [p1[0] + path for path in p2] + p1[1:]
-            pv = [cons_calls + [('DExcept', CHILD_EDGE)] + path for path in p]
-            p = self.get_ast_paths(js, i+1)
-            ph = [cons_calls + [('DExcept', SIBLING_EDGE)] + path for path in p]
-            return ph + pv
-
-        if node_type == 'DLoop':
-            pC = self.get_ast_paths(js[i]['_cond'])  # will have at most 1 "path"
-            assert len(pC) <= 1
-            p = self.get_ast_paths(js[i]['_body'])
-            pv = [cons_calls + [('DLoop', CHILD_EDGE)] + pC[0] + path for path in p]
-            p = self.get_ast_paths(js, i+1)
-            ph = [cons_calls + [('DLoop', SIBLING_EDGE)] + path for path in p]
-            return ph + pv
-
-    def read_data(self, filename):
-        with open(filename) as f:
-            js = json.load(f)
+    def read_cache(self, cache, new_vocab):
+        config = self.config
+        with open(os.path.join(cache, 'meta.json')) as f:
+            meta = json.load(f)
+        assert meta['version'] == CACHE_VERSION, 'Invalid cache version in {}'.format(cache)
+        if new_vocab:
+            config.decoder.chars = meta['chars']
+            config.decoder.vocab = dict(zip(config.decoder.chars, range(len(config.decoder.chars))))
+            config.decoder.vocab_size = len(config.decoder.vocab)
+
+        inputs = [np.load(os.path.join(cache, 'input{}.npy'.format(i)), mmap_mode='r')
+                  for i in range(len(config.evidence))]
+        nodes = np.load(os.path.join(cache, 'nodes.npy'), mmap_mode='r')
+        edges = np.load(os.path.join(cache, 'edges.npy'), mmap_mode='r')
+        targets = np.load(os.path.join(cache, 'targets.npy'), mmap_mode='r')
+        lengths = np.load(os.path.join(cache, 'lengths.npy'), mmap_mode='r')
+        programs = np.load(os.path.join(cache, 'programs.npy'))
+        return inputs, nodes, edges, targets, lengths, programs
+
+    def read_data(self, programs, vocab):
+        """Read the evidences and AST paths of each program (flattened node ids through vocab, edges and path
+        lengths, see utils.ast_paths), ignoring programs that do not fit the config"""
         evidences, targets = [], []
         ignored, done = 0, 0
 
-        for program in js['programs']:
+        for program in programs:
             if 'ast' not in program:
                 continue
             try:
                 evidence = [ev.read_data_point(program) for ev in self.config.evidence]
-                ast_paths = self.get_ast_paths(program['ast']['_nodes'])
-                for path in ast_paths:
-                    path.insert(0, ('DSubTree', CHILD_EDGE))
-                    assert len(path) <= self.config.decoder.max_ast_depth
-                    evidences.append(evidence)
-                    targets.append(path)
+                targets.append(ast_paths(program['ast']['_nodes'], self.config.decoder.max_ast_depth, vocab))
+                evidences.append(evidence)
             except AssertionError:
                 ignored += 1
             done += 1
-            print('{:8d} programs in training data'.format(done), end='\r')
-        print('\n{:8d} programs ignored by given config'.format(ignored))
 
-        # randomly shuffle to avoid bias towards initial data points during training
-        data_points = list(zip(evidences, targets))
-        random.shuffle(data_points)
-        evidences, targets = zip(*data_points)
-
-        return evidences, targets
+        return evidences, targets, ignored, done
 
     def next_batch(self):
-        batch = next(self.batches)
-        n, e, y = batch[:3]
-        ev_data = batch[3:]
+        return next(self.batches)
+
+    def get_batch(self, idx, data=None):
+        # gather the batch (sorted, for locality in memory-mapped arrays), trimmed to its longest path
+        inputs, nodes, edges, targets, lengths = data if data is not None else \
+            (self.inputs, self.nodes, self.edges, self.targets, self.lengths)
+        idx = np.sort(idx)
+        l = lengths[idx]
+        depth = np.max(l)
+        n = nodes[idx][:, :depth]
+        e = np.unpackbits(edges[idx], axis=1)[:, :depth].astype(np.bool)
+        y = targets[idx][:, :depth]
+        ev_data = [ev_data[idx] for ev_data in inputs]
+
+        return ev_data, n, e, y, l
+
+    def prefetch_batches(self, batches):
+        """Generator of batches that are prepared ahead by a background thread. The thread stops when the generator
+        is closed (see close_batches), even if not all batches were consumed."""
+        prepared = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            # wait for room in the queue, unless the consumer has stopped
+            while not stop.is_set():
+                try:
+                    prepared.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prepare():
+            try:
+                for idx in batches:
+                    if not put(self.get_batch(idx)):
+                        return
+                put(None)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=prepare)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                batch = prepared.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            stop.set()
+            while not prepared.empty():  # free the batches prepared in vain
+                prepared.get_nowait()
+            thread.join()
+
+    def close_batches(self):
+        """Stop preparing the batches of the current epoch (if they were not all consumed)"""
+        if self.batches is not None:
+            self.batches.close()
+            self.batches = None
+
+    def reset_batches(self, skip=0):
+        # randomly shuffle every epoch to avoid bias towards initial data points during training, then
+        # bucket the data points by path length (the stable sort keeps them shuffled within a length)
+        # into batches, shuffle the batches and keep the ones in this shard (skipping the first few,
+        # when resuming an epoch from the shuffle state it started with)
+        self.shuffle_state = self.rng.get_state()
+        sz = self.total_batches * self.config.batch_size
+        perm = self.train_idx[self.rng.permutation(len(self.train_idx))][:sz]
+        perm = perm[np.argsort(self.lengths[perm], kind='mergesort')]
+        splits = np.split(perm, self.total_batches)
+        order = self.rng.permutation(self.total_batches)[self.shard::self.num_shards][skip:self.config.num_batches]
+
+        batches = (splits[i] for i in order)
+        self.close_batches()
+        if self.prefetch > 0:
+            self.batches = self.prefetch_batches(batches)
+        else:
+            self.batches = (self.get_batch(idx) for idx in batches)
+
+    def validation_batches(self):
+        """Batches of the held-out data, bucketed by path length"""
+        order = np.argsort(self.valid[-1], kind='mergesort')
+        for i in range(0, len(order), self.config.batch_size):
+            yield self.get_batch(order[i:i + self.config.batch_size], self.valid)
+
+    def resume_batches(self, shuffle_state, skip):
+        self.rng.set_state(shuffle_state)
+        self.reset_batches(skip)
+
+
+# the reader in each worker process used by Reader.preprocess
+_reader = None
+
+
+def _init_worker(reader):
+    global _reader
+    _reader = reader
+
 
-        # reshape the batch into required format
-        rn = np.transpose(n)
-        re = np.transpose(e)
+def _wrangle_chunk(programs):
+    return _reader.wrangle_chunk(programs)
 
-        return ev_data, rn, re, y
 
-    def reset_batches(self):
-        self.batches = iter(zip(self.nodes, self.edges, self.targets, *self.inputs))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=HELP)
+    parser.add_argument('input_file', type=str, nargs=1,
+                        help='input data file')
+    parser.add_argument('--cache_dir', type=str, required=True,
+                        help='directory to store preprocessed data in')
+    parser.add_argument('--save', type=str, default='save',
+                        help='directory with the embeddings (same as for training)')
+    parser.add_argument('--config', type=str, default=None,
+                        help='config file (see train.py for help)')
+    parser.add_argument('--continue_from', type=str, default=None,
+                        help='preprocess for continuing to train the model checkpointed here')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes to preprocess the data with')
+    parser.set_defaults(seed=None, prefetch=0, num_replicas=1, task_index=0,  # only used for training
+                        validation_file=None, validation_split=0.)
+    clargs = parser.parse_args()
+    if clargs.config and clargs.continue_from:
+        parser.error('Do not provide --config if you are continuing from checkpointed model')
+    if not clargs.config and not clargs.continue_from:
+        parser.error('Provide at least one option: --config or --continue_from')
+    config_file = clargs.config if clargs.continue_from is None \
+        else os.path.join(clargs.continue_from, 'config.json')
+    with open(config_file) as f:
+        config = read_config(json.load(f), save_dir=clargs.save, infer=clargs.continue_from is not None)
+    Reader(clargs, config)
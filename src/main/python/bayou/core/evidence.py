@@ -17,10 +17,15 @@ import numpy as np
 import os
 import re
 import json
+import tempfile
+from itertools import chain
 
-from bayou.core.utils import CONFIG_ENCODER, C0, UNK
+from bayou.core.utils import CONFIG_ENCODER, C0, UNK, UNSAVED_VARIABLES, pad, lookup_tokens
 from bayou.lda.model import LDA
 
+JAVADOC_EMBEDDING = 'embedding.npy'  # normalized javadoc embedding, cached next to the checkpoint it is read from
+_javadoc_embeddings = {}  # the vocabulary and embedding of each embed_javadoc directory, shared by all orders
+
 
 class Evidence(object):
 
@@ -90,10 +95,10 @@ class APICalls(Evidence):
         return list(set(apicalls))
 
     def wrangle(self, data):
-        return np.array(self.lda.infer(data), dtype=np.float32)
+        return self.lda.infer(data).astype(np.float32)
 
     def placeholder(self, config):
-        return tf.placeholder(tf.float32, [config.batch_size, self.lda.model.n_topics])
+        return tf.placeholder(tf.float32, [None, self.lda.model.n_topics])
 
     def exists(self, inputs):
         return tf.not_equal(tf.count_nonzero(inputs, axis=1), 0)
@@ -134,10 +139,10 @@ class Types(Evidence):
         return list(set(types))
 
     def wrangle(self, data):
-        return np.array(self.lda.infer(data), dtype=np.float32)
+        return self.lda.infer(data).astype(np.float32)
 
     def placeholder(self, config):
-        return tf.placeholder(tf.float32, [config.batch_size, self.lda.model.n_topics])
+        return tf.placeholder(tf.float32, [None, self.lda.model.n_topics])
 
     def exists(self, inputs):
         return tf.not_equal(tf.count_nonzero(inputs, axis=1), 0)
@@ -177,10 +182,10 @@ class Context(Evidence):
         return list(set(context))
 
     def wrangle(self, data):
-        return np.array(self.lda.infer(data), dtype=np.float32)
+        return self.lda.infer(data).astype(np.float32)
 
     def placeholder(self, config):
-        return tf.placeholder(tf.float32, [config.batch_size, self.lda.model.n_topics])
+        return tf.placeholder(tf.float32, [None, self.lda.model.n_topics])
 
     def exists(self, inputs):
         return tf.not_equal(tf.count_nonzero(inputs, axis=1), 0)
@@ -224,29 +229,45 @@ class Javadoc(Evidence):
 
     def load_embedding(self, save_dir):
         embed_save_dir = os.path.join(save_dir, 'embed_javadoc')
+        if embed_save_dir not in _javadoc_embeddings:
+            _javadoc_embeddings[embed_save_dir] = self.read_embedding(embed_save_dir)
+        self.chars, self.vocab, self.final_embedding = _javadoc_embeddings[embed_save_dir]
+        # max_sentence_length could also be pre-determined and hard-coded
+        # self.max_sentence_length = js['javadoc_' + self.order + '_max_length']
+
+    def read_embedding(self, embed_save_dir):
         # vocabulary
         with open(os.path.join(embed_save_dir, 'config.json')) as f:
             js = json.load(f)
-        self.chars = js['chars']
         # add padding character
-        self.chars = [self.pad_char] + self.chars
-        self.vocab = dict(zip(self.chars, range(len(self.chars))))
-        # self.vocab_size = len(self.vocab)
-        # max_sentence_length could also be pre-determined and hard-coded
-        # self.max_sentence_length = js['javadoc_' + self.order + '_max_length']
-        # embedding
-        with tf.Session() as sess:
-            embedding = tf.get_variable('embedding_' + self.order, [js['vocab_size'], js['embedding_size']],
-                                        dtype=tf.float32, trainable=False)
-            norm = tf.sqrt(tf.reduce_sum(tf.square(embedding), 1, keep_dims=True))
-            normalized_embedding = embedding / norm
-            saver = tf.train.Saver({'embedding': embedding})
-            ckpt = tf.train.get_checkpoint_state(embed_save_dir)
-            saver.restore(sess, ckpt.model_checkpoint_path)
-            # numpy array
-            self.final_embedding = normalized_embedding.eval()
-            # add embedding for padding character
-            self.final_embedding = np.append([[0] * js['embedding_size']], self.final_embedding, axis=0)
+        chars = [self.pad_char] + js['chars']
+        vocab = dict(zip(chars, range(len(chars))))
+
+        # embedding, from the cache unless the checkpoint was saved after it
+        cache = os.path.join(embed_save_dir, JAVADOC_EMBEDDING)
+        if os.path.exists(cache) and \
+                os.path.getmtime(cache) >= os.path.getmtime(os.path.join(embed_save_dir, 'checkpoint')):
+            try:
+                return chars, vocab, np.load(cache)
+            except (IOError, ValueError):  # a cache that cannot be read is recomputed
+                pass
+        ckpt = tf.train.get_checkpoint_state(embed_save_dir)
+        embedding = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path).get_tensor('embedding')
+        embedding = embedding / np.sqrt(np.sum(np.square(embedding), axis=1, keepdims=True))
+        # add embedding for padding character
+        final_embedding = np.append(np.zeros([1, js['embedding_size']], dtype=np.float32), embedding, axis=0)
+        # written to a temporary file that replaces the cache, so that readers never see a partial cache
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=embed_save_dir)
+        except (IOError, OSError):  # the cache is only an optimization
+            return chars, vocab, final_embedding
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, final_embedding)
+            os.replace(tmp, cache)
+        except (IOError, OSError):
+            os.remove(tmp)
+        return chars, vocab, final_embedding
 
     # def read_data_point(self, program, infer=False):
     def read_data_point(self, program):
@@ -263,28 +284,20 @@ class Javadoc(Evidence):
         # if len(javadoc) > self.max_sentence_length:
         #     self.max_sentence_length = len(javadoc)
         # replace words not in the dictionary with unknown
-        javadoc = [i if i in self.chars else UNK for i in javadoc]
+        javadoc = [i if i in self.vocab else UNK for i in javadoc]
 
         return javadoc
 
     def wrangle(self, data):
-        # index words and pad and trim word vectors
-        indices_list = []
-        for s in data:
-            padding_length = self.max_sentence_length - len(s)
-            if padding_length > 0:
-                s.extend([self.pad_char] * padding_length)
-                words = s
-            elif padding_length < 0:
-                words = s[:padding_length]
-            else:
-                words = s
-            indices = list(map(self.vocab.get, words))
-            indices_list.append(indices)
-        return np.array(indices_list, dtype=np.int32)
+        # index the words of all javadocs at once, trimmed and padded (with the padding character) to the same length
+        data = [s[:self.max_sentence_length] for s in data]
+        lengths = np.array([len(s) for s in data], dtype=np.int32)
+        indices = lookup_tokens(list(chain.from_iterable(data)), self.vocab)
+        return pad(indices, lengths, self.max_sentence_length)
 
     def placeholder(self, config):
-        return tf.placeholder(tf.int32, [config.batch_size, self.max_sentence_length])
+        # javadocs are padded to max_sentence_length in the data, but encode() works on any length
+        return tf.placeholder(tf.int32, [None, None])
 
     def exists(self, inputs):
         return tf.not_equal(tf.count_nonzero(inputs, axis=1), 0)
@@ -293,50 +306,61 @@ class Javadoc(Evidence):
         with tf.variable_scope('javadoc_' + self.order):
             self.sigma = tf.get_variable('sigma', [])
 
-    def encode(self, inputs, config):
-        with tf.variable_scope('javadoc_' + self.order):
-            # step. make embedding a variable tensor
-            # W = tf.get_variable(name="W", shape=embedding.shape, tf.constant_initializer(embedding), trainable=False)
+    def embedding(self):
+        # a single (non-trainable) copy of the embedding in the graph, shared by the javadocs of all orders (if
+        # called from the same scope, outside the scope of each order). It is built from embedding.npy, so it is not
+        # saved in checkpoints, which also keeps them independent of where the variable is in the graph.
+        # NOTE: Javadoc models trained before the encoder pooled over the words of each javadoc only (ignoring the
+        # padding) must be retrained, as their filters were trained on different features
+        scope = tf.get_variable_scope().name
+        name = (scope + '/' if scope else '') + 'javadoc/embedding/W'
+        for var in tf.global_variables():
+            if var.op.name == name:
+                return var
+        with tf.variable_scope('javadoc'):
             with tf.variable_scope('embedding'):
-                W = tf.get_variable(
+                return tf.get_variable(
                     name='W',
                     shape=list(self.final_embedding.shape),
                     initializer=tf.constant_initializer(self.final_embedding),
-                    trainable=False)
-                embedded_chars = tf.nn.embedding_lookup(W, inputs)
-                embedded_chars_expanded = tf.expand_dims(embedded_chars, -1)
+                    trainable=False,
+                    collections=[tf.GraphKeys.GLOBAL_VARIABLES, UNSAVED_VARIABLES])
 
-            # convolution and pooling layers
-            pooled_outputs = []
+    def encode(self, inputs, config):
+        # trim the padding common to the whole batch (words are never 0, the padding character), and look up the
+        # embedding shared by all orders
+        lengths = tf.count_nonzero(inputs, axis=1, dtype=tf.int32)
+        min_size, max_size = min(self.filter_sizes), max(self.filter_sizes)
+        inputs = inputs[:, :tf.maximum(tf.reduce_max(lengths), min_size)]
+        embedded_chars = tf.nn.embedding_lookup(self.embedding(), inputs)
+
+        with tf.variable_scope('javadoc_' + self.order):
+            # convolution with all filter sizes at once: the filters are padded with zeros to the largest size, and
+            # the javadocs with the padding character (whose embedding is zero) so that all windows fit
+            filters, biases, limits = [], [], []
             embedding_size = self.final_embedding.shape[1]
             for i, filter_size in enumerate(self.filter_sizes):
                 with tf.variable_scope('conv-maxpool-%s' % filter_size):
-                    # convolution
                     filter_shape = [filter_size, embedding_size, 1, self.num_filters]
                     # hyper-parameters
                     W = tf.Variable(tf.truncated_normal(filter_shape, stddev=0.1), name='W')
                     b = tf.Variable(tf.constant(0.1, shape=[self.num_filters]), name='b')
-                    conv = tf.nn.conv2d(
-                        embedded_chars_expanded,
-                        W,
-                        strides=[1, 1, 1, 1],
-                        padding='VALID',
-                        name='conv')
-                    # non-linearity
-                    h = tf.nn.relu(tf.nn.bias_add(conv, b), name='relu')
-                    # max pooling -> tensor([batch_size, 1, 1, num_filters])
-                    pooled = tf.nn.max_pool(
-                        h,
-                        ksize=[1, self.max_sentence_length - filter_size + 1, 1, 1],
-                        strides=[1, 1, 1, 1],
-                        padding='VALID',
-                        name='pool')
-                    pooled_outputs.append(pooled)
-
-            # combine all the pooled features
+                    filters.append(tf.pad(tf.reshape(W, filter_shape[:2] + filter_shape[3:]),
+                                          [[0, max_size - filter_size], [0, 0], [0, 0]]))
+                    biases.append(b)
+                    # last window (at least the first one) that lies within each javadoc
+                    limits.append(tf.tile(tf.expand_dims(tf.maximum(lengths - filter_size, 0), 1),
+                                          [1, self.num_filters]))
+            embedded_chars = tf.pad(embedded_chars, [[0, 0], [0, max_size - min_size], [0, 0]])
+            conv = tf.nn.conv1d(embedded_chars, tf.concat(filters, 2), stride=1, padding='VALID')
+            conv = tf.nn.bias_add(conv, tf.concat(biases, 0))
+
+            # max pooling over the windows within the javadoc, and non-linearity -> tensor([batch_size, num_filters])
+            positions = tf.reshape(tf.range(tf.shape(conv)[1]), [1, -1, 1])
+            mask = tf.less_equal(positions, tf.expand_dims(tf.concat(limits, 1), 1))
+            conv = tf.where(mask, conv, tf.fill(tf.shape(conv), -np.inf))
+            h_pool_flat = tf.nn.relu(tf.reduce_max(conv, axis=1), name='relu')
             num_filters_total = self.num_filters * len(self.filter_sizes)
-            h_pool = tf.concat(pooled_outputs, 3)
-            h_pool_flat = tf.reshape(h_pool, [-1, num_filters_total])
 
             # dropout
             with tf.variable_scope('dropout'):
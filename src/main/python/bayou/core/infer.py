@@ -23,7 +23,7 @@ import collections
 
 from bayou.core.model import Model
 from bayou.core.utils import CHILD_EDGE, SIBLING_EDGE
-from bayou.core.utils import read_config
+from bayou.core.utils import read_config, saved_variables
 
 MAX_GEN_UNTIL_STOP = 20
 MAX_AST_DEPTH = 5
@@ -41,7 +41,7 @@ class BayesianPredictor(object):
 
         # restore the saved model
         tf.global_variables_initializer().run()
-        saver = tf.train.Saver(tf.global_variables())
+        saver = tf.train.Saver(saved_variables())
         ckpt = tf.train.get_checkpoint_state(save)
         saver.restore(self.sess, ckpt.model_checkpoint_path)
 
@@ -56,6 +56,9 @@ class BayesianPredictor(object):
     def psi_from_evidence(self, js_evidences):
         return self.model.infer_psi(self.sess, js_evidences)
 
+    def psi_from_evidence_batch(self, js_evidences_list, mean=False):
+        return self.model.infer_psi_batch(self.sess, js_evidences_list, mean=mean)
+
     def gen_until_STOP(self, psi, depth, in_nodes, in_edges, check_call=False):
         ast = []
         nodes, edges = in_nodes[:], in_edges[:]
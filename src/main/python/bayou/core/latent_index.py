@@ -0,0 +1,124 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import numpy as np
+
+import argparse
+import os
+
+from bayou.core.corpus import Corpus, CorpusWriter
+from bayou.core.programs import read_programs, chunks
+
+HELP = """Use this to build a nearest-neighbor index over the latent space of a trained model.
+Every program in the input data file is encoded with the posterior mean of Psi given its evidences,
+and the index is saved to the given directory (by default the "index" folder in the model directory).
+The input is read as a stream, and can be a JSON or JSON-lines file or a corpus directory (see bayou.core.corpus)."""
+
+INDEX_PSI = 'psi.npy'
+INDEX_ASTS = 'asts'  # corpus of the AST (and its calls) of each program
+
+
+def get_calls(js):
+    node = js['node']
+    if node == 'DAPICall':
+        return [js['_call']]
+    children = {'DSubTree': ['_nodes'],
+                'DBranch': ['_cond', '_then', '_else'],
+                'DExcept': ['_try', '_catch'],
+                'DLoop': ['_cond', '_body']}[node]
+    return [call for child in children for c in js[child] for call in get_calls(c)]
+
+
+class LatentIndex(object):
+    """Exact nearest-neighbor search over latent vectors, computed block-wise in NumPy"""
+
+    def __init__(self, index_dir, block_size=65536):
+        self.psis = np.load(os.path.join(index_dir, INDEX_PSI), mmap_mode='r')
+        self.asts = Corpus(os.path.join(index_dir, INDEX_ASTS))  # read only when retrieved
+        assert len(self.asts) == self.psis.shape[0], 'Corrupted index in {}'.format(index_dir)
+        self.block_size = block_size
+
+        # precompute squared norms, so that each block costs a single matrix product
+        self.norms = np.concatenate([np.sum(np.square(self.psis[i:i + block_size]), axis=1)
+                                     for i in range(0, len(self.asts), block_size)])
+
+    def nearest(self, psi, k=10):
+        """Return the indices and squared distances of the k nearest programs to each row of psi"""
+        psi = np.atleast_2d(psi).astype(np.float32)
+        k = min(k, len(self.asts))
+        rows = np.arange(psi.shape[0])[:, np.newaxis]
+        best_idx = np.zeros((psi.shape[0], 0), dtype=np.int64)
+        best_dist = np.zeros((psi.shape[0], 0), dtype=np.float32)
+
+        for start in range(0, len(self.asts), self.block_size):
+            block = self.psis[start:start + self.block_size]
+            dist = self.norms[start:start + len(block)] - 2. * np.dot(psi, block.T)
+            idx = np.tile(np.arange(start, start + len(block)), (psi.shape[0], 1))
+
+            # merge with the best found so far and keep only the top-k
+            best_dist = np.concatenate([best_dist, dist], axis=1)
+            best_idx = np.concatenate([best_idx, idx], axis=1)
+            if best_dist.shape[1] > k:
+                top = np.argpartition(best_dist, k - 1, axis=1)[:, :k]
+                best_dist, best_idx = best_dist[rows, top], best_idx[rows, top]
+
+        order = np.argsort(best_dist, axis=1)
+        best_dist, best_idx = best_dist[rows, order], best_idx[rows, order]
+        return best_idx, best_dist + np.sum(np.square(psi), axis=1, keepdims=True)
+
+    def retrieve(self, psi, k=10):
+        """Return the k nearest known ASTs to a single latent vector"""
+        idx, _ = self.nearest(psi, k)
+        return [dict(entry['ast'], calls=entry['calls']) for entry in (self.asts[int(i)] for i in idx[0])]
+
+
+def build_index(clargs):
+    # the model is only needed to build the index, so that searching it does not need TensorFlow
+    import tensorflow as tf
+    from bayou.core.infer import BayesianPredictor
+
+    index_dir = clargs.index_dir if clargs.index_dir is not None else os.path.join(clargs.save, 'index')
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    programs = (program for program in read_programs(clargs.input_file[0]) if 'ast' in program)
+
+    psis = []
+    with tf.Session() as sess, CorpusWriter(os.path.join(index_dir, INDEX_ASTS)) as asts:
+        print('Loading model...')
+        predictor = BayesianPredictor(clargs.save, sess)
+        for chunk in chunks(programs, clargs.chunk_size):
+            psis.append(predictor.model.infer_psi_batch(sess, chunk, chunk_size=clargs.chunk_size, mean=True))
+            for program in chunk:
+                asts.write({'ast': program['ast'], 'calls': list(set(get_calls(program['ast'])))})
+            print('Encoded {} programs'.format(asts.count), end='\r')
+        print()
+    psis = np.concatenate(psis, axis=0) if psis else np.zeros((0, predictor.model.config.latent_size))
+    np.save(os.path.join(index_dir, INDEX_PSI), psis.astype(np.float32))
+    print('Saved index of {} programs to {}'.format(len(psis), index_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=HELP)
+    parser.add_argument('input_file', type=str, nargs=1,
+                        help='input data file (training programs), or corpus directory')
+    parser.add_argument('--save', type=str, required=True,
+                        help='directory to load model from')
+    parser.add_argument('--index_dir', type=str, default=None,
+                        help='directory to save the index to (default: <save>/index)')
+    parser.add_argument('--chunk_size', type=int, default=1024,
+                        help='number of programs to read and encode at a time')
+    clargs = parser.parse_args()
+    build_index(clargs)
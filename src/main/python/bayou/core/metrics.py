@@ -0,0 +1,88 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import json
+import os
+import resource
+import time
+
+METRICS = 'metrics.jsonl'  # training metrics, one JSON object per line (see MetricsLog)
+
+
+def resource_usage():
+    """Return the resident memory (bytes) and the total CPU time (seconds) of this process"""
+    try:
+        with open('/proc/self/statm') as f:
+            rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # peak, where statm is not available
+    times = os.times()
+    return rss, times[0] + times[1]
+
+
+class MetricsLog(object):
+    """Log of training metrics as JSON lines, with a "type" of either "step" or "epoch".
+
+    Step records aggregate the steps since the previous one: throughput (examples and tokens per second),
+    the average time spent waiting for data and computing per step, the average losses, and the memory
+    and CPU usage of the process."""
+
+    def __init__(self, filename):
+        self.file = open(filename, 'a')
+        self.last_time = time.time()
+        _, self.last_cpu = resource_usage()
+        self.reset()
+
+    def reset(self):
+        self.steps = self.examples = self.tokens = 0
+        self.wait = self.compute = 0.
+        self.losses = {}
+
+    def update(self, examples, tokens, wait, compute, **losses):
+        self.steps += 1
+        self.examples += examples
+        self.tokens += tokens
+        self.wait += wait
+        self.compute += compute
+        for k, v in losses.items():
+            self.losses[k] = self.losses.get(k, 0.) + float(v)
+
+    def log_steps(self, **fields):
+        now = time.time()
+        rss, cpu = resource_usage()
+        elapsed = max(now - self.last_time, 1e-9)
+        record = dict(fields, type='step',
+                      steps=self.steps,
+                      examples_per_sec=self.examples / elapsed,
+                      tokens_per_sec=self.tokens / elapsed,
+                      data_time=self.wait / max(self.steps, 1),
+                      compute_time=self.compute / max(self.steps, 1),
+                      rss_mb=rss / float(1 << 20),
+                      cpu_percent=100. * (cpu - self.last_cpu) / elapsed)
+        record.update({k: v / max(self.steps, 1) for k, v in self.losses.items()})
+        self.write(record)
+        self.last_time, self.last_cpu = now, cpu
+        self.reset()
+        return record
+
+    def log_epoch(self, **fields):
+        self.write(dict(fields, type='epoch'))
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -13,7 +13,6 @@
 # limitations under the License.
 
 import tensorflow as tf
-from tensorflow.contrib import legacy_seq2seq as seq2seq
 import numpy as np
 
 from bayou.core.architecture import BayesianEncoder, BayesianDecoder
@@ -21,7 +20,7 @@ from bayou.core.data_reader import CHILD_EDGE, SIBLING_EDGE
 
 
 class Model():
-    def __init__(self, config, infer=False):
+    def __init__(self, config, infer=False, num_replicas=1):
         self.config = config
         if infer:
             config.batch_size = 1
@@ -29,7 +28,7 @@ class Model():
 
         # setup the encoder
         self.encoder = BayesianEncoder(config)
-        samples = tf.random_normal([config.batch_size, config.latent_size],
+        samples = tf.random_normal(tf.shape(self.encoder.psi_mean),
                                    mean=0., stddev=1., dtype=tf.float32)
         self.psi = self.encoder.psi_mean + tf.sqrt(self.encoder.psi_covariance) * samples
 
@@ -40,15 +39,16 @@ class Model():
         self.decoder = BayesianDecoder(config, initial_state=self.initial_state, infer=infer)
 
         # get the decoder outputs
-        output = tf.reshape(tf.concat(self.decoder.outputs, 1),
-                            [-1, self.decoder.cell1.output_size])
+        output = tf.reshape(self.decoder.outputs, [-1, self.decoder.cell1.output_size])
         logits = tf.matmul(output, self.decoder.projection_w) + self.decoder.projection_b
         self.probs = tf.nn.softmax(logits)
 
-        # 1. generation loss: log P(X | \Psi)
-        self.targets = tf.placeholder(tf.int32, [config.batch_size, config.decoder.max_ast_depth])
-        self.gen_loss = seq2seq.sequence_loss([logits], [tf.reshape(self.targets, [-1])],
-                                              [tf.ones([config.batch_size * config.decoder.max_ast_depth])])
+        # 1. generation loss: log P(X | \Psi), averaged over the positions that are not padding
+        self.targets = tf.placeholder(tf.int32, [None, None])
+        cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.reshape(self.targets, [-1]),
+                                                                       logits=logits)
+        mask = tf.reshape(self.decoder.mask, [-1])
+        self.gen_loss = tf.reduce_sum(cross_entropy * mask) / tf.maximum(tf.reduce_sum(mask), 1.)
 
         # 2. latent loss: KL-divergence between P(\Psi | f(\Theta)) and P(\Psi)
         latent_loss = 0.5 * tf.reduce_sum(- tf.log(self.encoder.psi_covariance)
@@ -62,9 +62,20 @@ class Model():
         evidence_loss = [tf.reduce_sum(loss, axis=1) for loss in evidence_loss]
         self.evidence_loss = config.beta * tf.reduce_sum(tf.stack(evidence_loss), axis=0)
 
-        # The optimizer
+        # The optimizer (in data-parallel training, gradients are averaged synchronously over the replicas).
+        # The learning rate can be fed to decay it during training.
         self.loss = self.gen_loss + self.latent_loss + self.evidence_loss
-        self.train_op = tf.train.AdamOptimizer(config.learning_rate).minimize(self.loss)
+        self.learning_rate = tf.placeholder_with_default(np.float32(config.learning_rate), [])
+        optimizer = tf.train.AdamOptimizer(self.learning_rate)
+        if num_replicas > 1:
+            self.global_step = tf.Variable(0, name='global_step', trainable=False)
+            optimizer = tf.train.SyncReplicasOptimizer(optimizer, replicas_to_aggregate=num_replicas,
+                                                       total_num_replicas=num_replicas)
+            self.train_op = optimizer.minimize(self.loss, global_step=self.global_step)
+            self.sync_init_op = optimizer.get_init_tokens_op()
+            self.chief_queue_runner = optimizer.get_chief_queue_runner()
+        else:
+            self.train_op = optimizer.minimize(self.loss)
 
         var_params = [np.prod([dim.value for dim in var.get_shape()])
                       for var in tf.trainable_variables()]
@@ -82,6 +93,22 @@ class Model():
         psi = sess.run(self.psi, feed)
         return psi
 
+    def infer_psi_batch(self, sess, evidences, chunk_size=1024, mean=False):
+        # read and wrangle the data in bulk, so that each evidence type is wrangled only once
+        inputs = [ev.wrangle([ev.read_data_point(evidence) for evidence in evidences])
+                  for ev in self.config.evidence]
+
+        # run the encoder on fixed-size chunks of the (dynamic) batch dimension
+        # (optionally returning the posterior mean of psi instead of a sample)
+        fetch = self.encoder.psi_mean if mean else self.psi
+        psis = []
+        for start in range(0, len(evidences), chunk_size):
+            feed = {}
+            for j, ev in enumerate(self.config.evidence):
+                feed[self.encoder.inputs[j].name] = inputs[j][start:start + chunk_size]
+            psis.append(sess.run(fetch, feed))
+        return np.concatenate(psis, axis=0) if psis else np.zeros((0, self.config.latent_size))
+
     def infer_ast(self, sess, psi, nodes, edges):
         # use the given psi and get decoder's start state
         state = sess.run(self.initial_state, {self.psi: psi})
@@ -89,12 +116,13 @@ class Model():
         # run the decoder for every time step
         for node, edge in zip(nodes, edges):
             assert edge == CHILD_EDGE or edge == SIBLING_EDGE, 'invalid edge: {}'.format(edge)
-            n = np.array([self.config.decoder.vocab[node]], dtype=np.int32)
-            e = np.array([edge == CHILD_EDGE], dtype=np.bool)
+            n = np.array([[self.config.decoder.vocab[node]]], dtype=np.int32)
+            e = np.array([[edge == CHILD_EDGE]], dtype=np.bool)
 
             feed = {self.decoder.initial_state: state,
-                    self.decoder.nodes[0].name: n,
-                    self.decoder.edges[0].name: e}
+                    self.decoder.nodes: n,
+                    self.decoder.edges: e,
+                    self.decoder.lengths: [1]}
             [probs, state] = sess.run([self.probs, self.decoder.state], feed)
 
         dist = probs[0]
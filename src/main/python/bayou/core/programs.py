@@ -0,0 +1,194 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import json
+import os
+import collections
+import multiprocessing
+import queue
+from itertools import islice
+
+from bayou.core.corpus import Corpus, is_corpus
+
+# Reading and writing files of programs, and processing them in worker processes. This module does not depend on
+# TensorFlow, so that tools that only handle data files do not need it.
+
+PARTIAL = '.partial'  # suffix of a file of programs being written
+
+
+# iterate over the programs in a data file without loading the whole file. The file is either in the
+# usual {"programs": [...]} format or, if its name ends with .jsonl, in JSON-lines format (one program per line).
+# A corpus directory (see bayou.core.corpus) can be given instead of a file.
+def read_programs(filename, chunk_size=1 << 20):
+    if is_corpus(filename):
+        for program in Corpus(filename):
+            yield program
+        return
+
+    with open(filename) as f:
+        if filename.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buf, idx, eof = '', 0, False
+
+        def fill():
+            nonlocal buf, idx, eof
+            data = f.read(chunk_size)
+            eof = data == ''
+            buf, idx = buf[idx:] + data, 0
+
+        def skip(separators=''):
+            # skip whitespace and separators, reading more of the file as needed
+            nonlocal idx
+            while True:
+                while idx < len(buf) and (buf[idx].isspace() or buf[idx] in separators):
+                    idx += 1
+                if idx < len(buf) or eof:
+                    return buf[idx:idx + 1]
+                fill()
+
+        def decode():
+            # decode the next value, reading more of the file until it is complete (a value ending exactly at the
+            # end of the buffer, e.g. a number, may continue in the file)
+            nonlocal idx
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, idx)
+                    if end < len(buf) or eof:
+                        idx = end
+                        return value
+                except ValueError:
+                    assert not eof, 'Unexpected end of file {}'.format(filename)
+                fill()
+
+        # skip the other keys of the top-level object to the beginning of the list of programs
+        assert skip() == '{', 'Could not find programs in {}'.format(filename)
+        idx += 1
+        while True:
+            assert skip(',') == '"', 'Could not find programs in {}'.format(filename)
+            key = decode()
+            assert skip() == ':', 'Malformed file {}'.format(filename)
+            idx += 1
+            skip()
+            if key == 'programs':
+                break
+            decode()
+        assert skip() == '[', 'Could not find programs in {}'.format(filename)
+        idx += 1
+
+        while True:
+            c = skip(',')
+            assert c != '', 'Unexpected end of file {}'.format(filename)
+            if c == ']':
+                return
+            yield decode()
+
+
+# write programs one at a time to a file, either in the usual {"programs": [...]} format (compact, with one program
+# per line) or, if its name ends with .jsonl, in JSON-lines format, so that they need not be held in memory. The
+# programs are written to <filename>.partial, which is renamed to filename by close, so that a file cut short by a
+# failure (see abort, which the with statement calls on an exception) is never taken for a complete one.
+class ProgramWriter(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename + PARTIAL, 'w')
+        self.jsonl = filename.endswith('.jsonl')
+        self.count = 0
+        if not self.jsonl:
+            self.file.write('{"programs": [\n')
+
+    def write(self, program):
+        if not self.jsonl and self.count > 0:
+            self.file.write(',\n')
+        self.file.write(json.dumps(program, separators=(',', ':')))
+        if self.jsonl:
+            self.file.write('\n')
+        self.count += 1
+
+    def close(self):
+        if not self.jsonl:
+            self.file.write('\n]}\n')
+        self.file.close()
+        os.replace(self.filename + PARTIAL, self.filename)
+
+    def abort(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+# split an iterable into lists of (at most) the given size
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# map func over an iterable with a pool of worker processes, returning the results in order (or, if not ordered, as
+# soon as they are ready). Unlike Pool.imap, at most a few items per worker are read ahead, so iterables that are
+# streamed from disk stay streamed. func must be picklable (defined at the top level of a module), and
+# initializer(*initargs) is run in every worker.
+def parallel_map(func, iterable, num_workers, initializer=None, initargs=(), ordered=True):
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in iterable:
+            yield func(item)
+        return
+
+    pool = multiprocessing.Pool(num_workers, initializer=initializer, initargs=initargs)
+    try:
+        if ordered:
+            pending = collections.deque()
+            for item in iterable:
+                pending.append(pool.apply_async(func, (item,)))
+                if len(pending) >= 2 * num_workers:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        else:
+            done, pending = queue.Queue(), 0
+
+            def result():
+                ok, value = done.get()
+                if not ok:
+                    raise value
+                return value
+            for item in iterable:
+                pool.apply_async(func, (item,), callback=lambda value: done.put((True, value)),
+                                 error_callback=lambda e: done.put((False, e)))
+                pending += 1
+                if pending >= 2 * num_workers:
+                    pending -= 1
+                    yield result()
+            for _ in range(pending):
+                yield result()
+    finally:
+        pool.terminate()
@@ -15,16 +15,24 @@
 from __future__ import print_function
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.client import timeline
 
 import argparse
 import time
 import os
+import sys
 import json
+import socket
+import subprocess
+import multiprocessing
+import contextlib
 import textwrap
 
+from bayou.core.checkpoint import CheckpointWriter, read_state, BEST_CHECKPOINT
 from bayou.core.data_reader import Reader
+from bayou.core.metrics import MetricsLog, METRICS
 from bayou.core.model import Model
-from bayou.core.utils import read_config, dump_config
+from bayou.core.utils import read_config, dump_config, saved_variables
 
 HELP = """\
 Config options should be given as a JSON file (see config.json for example):
@@ -60,82 +68,315 @@ Config options should be given as a JSON file (see config.json for example):
 }                                         |
 """
 
+TOTALS = ['loss', 'evidence', 'latent', 'generation', 'time', 'wait']
+PORT_IN_USE = 3  # exit code of a ps/worker process that could not bind its port
+LAUNCH_ATTEMPTS = 5
+
 
 def train(clargs):
+    if clargs.num_replicas > 1 and clargs.job_name is None:
+        launch(clargs)
+        return
+    if clargs.job_name == 'ps':
+        server = start_server(tf.train.ClusterSpec(json.loads(clargs.cluster)), clargs)
+        server.join()
+        return
+    is_chief = clargs.task_index == 0
+
     config_file = clargs.config if clargs.continue_from is None \
                                 else os.path.join(clargs.continue_from, 'config.json')
     with open(config_file) as f:
-        config = read_config(json.load(f), save_dir=clargs.save)
+        config = read_config(json.load(f), save_dir=clargs.save, infer=clargs.continue_from is not None)
     reader = Reader(clargs, config)
-    
+
     jsconfig = dump_config(config)
-    print(clargs)
-    print(json.dumps(jsconfig, indent=2))
-    with open(os.path.join(clargs.save, 'config.json'), 'w') as f:
-        json.dump(jsconfig, fp=f, indent=2)
+    if is_chief:
+        print(clargs)
+        print(json.dumps(jsconfig, indent=2))
+        with open(os.path.join(clargs.save, 'config.json'), 'w') as f:
+            json.dump(jsconfig, fp=f, indent=2)
+
+    if clargs.job_name == 'worker':
+        cluster = tf.train.ClusterSpec(json.loads(clargs.cluster))
+        server = start_server(cluster, clargs)
+        with tf.device(tf.train.replica_device_setter(
+                worker_device='/job:worker/task:{}'.format(clargs.task_index), cluster=cluster)):
+            model = Model(config, num_replicas=clargs.num_replicas)
+    else:
+        server = None
+        model = Model(config)
+    saver = tf.train.Saver(saved_variables())
+
+    with create_session(clargs, model, saver, server) as sess:
+        # resume where the checkpointed training stopped, if its training state was saved along with it
+        state = None
+        if clargs.continue_from is not None:
+            state = read_state(tf.train.get_checkpoint_state(clargs.continue_from).model_checkpoint_path)
+        start_epoch = state['epoch'] if state is not None else 0
+        best = read_state(os.path.join(clargs.save, BEST_CHECKPOINT)) if state is not None else None
+        checkpoint = CheckpointWriter(clargs.save, saved_variables(), clargs.keep,
+                                      best_loss=best['loss'] if best is not None else np.inf) if is_chief else None
+        metrics = MetricsLog(os.path.join(clargs.save, METRICS if is_chief
+                                          else 'metrics.worker{}.jsonl'.format(clargs.task_index)))
+        last_print = 0
+
+        # the learning rate schedule and early stopping, on the validation loss
+        schedule = state['schedule'] if state is not None and 'schedule' in state else \
+            {'learning_rate': config.learning_rate, 'best': None, 'bad_epochs': 0, 'lr_bad_epochs': 0}
+
+        # training
+        try:
+            for i in range(start_epoch, config.num_epochs):
+                if state is not None and i == start_epoch:
+                    # the totals are only carried over into an unfinished epoch (states saved at the end of an
+                    # epoch by older versions hold the totals of the finished one)
+                    start_batch = state['batch']
+                    totals = dict(state['totals']) if start_batch > 0 else dict.fromkeys(TOTALS, 0.)
+                    reader.resume_batches(state['shuffle'], start_batch)
+                else:
+                    start_batch, totals = 0, dict.fromkeys(TOTALS, 0.)
+                    reader.reset_batches()
+                for b in range(start_batch, config.num_batches):
+                    start = time.time()
+
+                    # setup the feed dict (waiting for the batch if it has not been prepared yet)
+                    ev_data, n, e, y, l = reader.next_batch()
+                    wait = time.time() - start
+                    feed = {model.targets: y,
+                            model.decoder.nodes: n,
+                            model.decoder.edges: e,
+                            model.decoder.lengths: l,
+                            model.learning_rate: schedule['learning_rate']}
+                    for j, ev in enumerate(config.evidence):
+                        feed[model.encoder.inputs[j].name] = ev_data[j]
+
+                    # run the optimizer (tracing the steps in the given window)
+                    step = i * config.num_batches + b
+                    tracing = clargs.trace_from <= step < clargs.trace_from + clargs.trace_steps
+                    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE) if tracing else None
+                    run_metadata = tf.RunMetadata() if tracing else None
+                    loss, evidence, latent, generation, mean, covariance, _ \
+                        = sess.run([model.loss,
+                                    model.evidence_loss,
+                                    model.latent_loss,
+                                    model.gen_loss,
+                                    model.encoder.psi_mean,
+                                    model.encoder.psi_covariance,
+                                    model.train_op], feed, options=run_options, run_metadata=run_metadata)
+                    end = time.time()
+                    if tracing:
+                        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+                        with open(os.path.join(clargs.save, 'timeline-{}.json'.format(step)), 'w') as f:
+                            f.write(trace)
+                    totals['time'] += end - start
+                    totals['wait'] += wait
+                    totals['loss'] += float(np.mean(loss))
+                    totals['evidence'] += float(np.mean(evidence))
+                    totals['latent'] += float(np.mean(latent))
+                    totals['generation'] += float(generation)
+                    metrics.update(len(l), int(np.sum(l - 1)), wait, end - start - wait,
+                                   loss=np.mean(loss), evidence=np.mean(evidence), latent=np.mean(latent),
+                                   generation=generation)
+                    if clargs.metrics_step > 0 and (step + 1) % clargs.metrics_step == 0:
+                        metrics.log_steps(step=step + 1, epoch=i)
+
+                    # print at most every print_interval seconds, since printing every step is costly
+                    if is_chief and step % config.print_step == 0 and end - last_print >= clargs.print_interval:
+                        last_print = end
+                        print('{}/{} (epoch {}), evidence: {:.3f}, latent: {:.3f}, generation: {:.3f}, '
+                              'loss: {:.3f}, mean: {:.3f}, covariance: {:.3f}, time: {:.3f} (data wait: {:.3f})'.format
+                              (step, config.num_epochs * config.num_batches, i,
+                               np.mean(evidence),
+                               np.mean(latent),
+                               generation,
+                               np.mean(loss),
+                               np.mean(mean),
+                               np.mean(covariance),
+                               end - start, wait))
+
+                    # checkpoint mid-epoch, with the shuffle this epoch started with to resume it
+                    if is_chief and clargs.checkpoint_step > 0 and (step + 1) % clargs.checkpoint_step == 0 \
+                            and b + 1 < config.num_batches:
+                        checkpoint.save(sess, step + 1, {'epoch': i, 'batch': b + 1, 'shuffle': reader.shuffle_state,
+                                                         'totals': dict(totals), 'schedule': dict(schedule)})
+                if not is_chief:
+                    continue
+                avg = {k: v / config.num_batches for k, v in totals.items()}
+                summary = {'epoch': i, 'step': (i + 1) * config.num_batches,
+                           'learning_rate': schedule['learning_rate'], 'train': avg}
+
+                # evaluate on the held-out data, and update the schedule
+                loss = avg['loss']
+                if reader.valid is not None:
+                    summary['validation'] = evaluate(sess, model, reader, config)
+                    loss = summary['validation']['loss']
+                    stop = update_schedule(schedule, loss, clargs)
+                else:
+                    stop = False
+
+                checkpoint.save(sess, (i + 1) * config.num_batches,
+                                {'epoch': i + 1, 'batch': 0, 'shuffle': reader.rng.get_state(),
+                                 'totals': dict.fromkeys(TOTALS, 0.), 'schedule': dict(schedule)}, loss=loss)
+                print('Model checkpointed: {}. Average for epoch evidence: {:.3f}, latent: {:.3f}, '
+                      'generation: {:.3f}, loss: {:.3f}, time: {:.3f}s (data wait: {:.3f}s)'.format
+                      (clargs.save,
+                       avg['evidence'],
+                       avg['latent'],
+                       avg['generation'],
+                       avg['loss'],
+                       totals['time'], totals['wait']))
+                if 'validation' in summary:
+                    print('Validation evidence: {:.3f}, latent: {:.3f}, generation: {:.3f}, loss: {:.3f} '
+                          '(best: {:.3f}), learning rate: {:g}'.format
+                          (summary['validation']['evidence'],
+                           summary['validation']['latent'],
+                           summary['validation']['generation'],
+                           loss, schedule['best'], schedule['learning_rate']))
+                metrics.log_epoch(**summary)
+                if stop:
+                    print('Validation loss has not improved for {} epochs, stopping'.format(clargs.patience))
+                    break
+        finally:
+            reader.close_batches()
+            metrics.close()
+            if checkpoint is not None:
+                checkpoint.close()
+
 
-    model = Model(config)
+def evaluate(sess, model, reader, config):
+    """Average losses over the held-out data (without training), weighted by the size of each batch"""
+    totals, count, targets = dict.fromkeys(['evidence', 'latent', 'generation'], 0.), 0, 0
+    for ev_data, n, e, y, l in reader.validation_batches():
+        feed = {model.targets: y,
+                model.decoder.nodes: n,
+                model.decoder.edges: e,
+                model.decoder.lengths: l}
+        for j, ev in enumerate(config.evidence):
+            feed[model.encoder.inputs[j].name] = ev_data[j]
+        evidence, latent, generation = sess.run([model.evidence_loss, model.latent_loss, model.gen_loss], feed)
+        totals['evidence'] += float(np.sum(evidence))
+        totals['latent'] += float(np.sum(latent))
+        totals['generation'] += float(generation) * int(np.sum(l - 1))  # generation loss is averaged over the nodes
+        count, targets = count + len(l), targets + int(np.sum(l - 1))
+    avg = {'evidence': totals['evidence'] / count,
+           'latent': totals['latent'] / count,
+           'generation': totals['generation'] / max(targets, 1)}
+    avg['loss'] = avg['evidence'] + avg['latent'] + avg['generation']
+    return avg
 
-    with tf.Session() as sess:
-        tf.global_variables_initializer().run()
-        saver = tf.train.Saver(tf.global_variables())
 
-        # restore model
+def update_schedule(schedule, loss, clargs):
+    """Decay the learning rate when the validation loss plateaus, and return whether to stop training early"""
+    if schedule['best'] is None or loss < schedule['best']:
+        schedule['best'], schedule['bad_epochs'], schedule['lr_bad_epochs'] = loss, 0, 0
+        return False
+    schedule['bad_epochs'] += 1
+    schedule['lr_bad_epochs'] += 1
+    if clargs.lr_patience > 0 and schedule['lr_bad_epochs'] >= clargs.lr_patience:
+        schedule['learning_rate'] *= clargs.lr_decay
+        schedule['lr_bad_epochs'] = 0
+    return clargs.patience > 0 and schedule['bad_epochs'] >= clargs.patience
+
+
+@contextlib.contextmanager
+def create_session(clargs, model, saver, server=None):
+    def restore(sess):
         if clargs.continue_from is not None:
             ckpt = tf.train.get_checkpoint_state(clargs.continue_from)
             saver.restore(sess, ckpt.model_checkpoint_path)
 
-        # training
-        for i in range(config.num_epochs):
-            reader.reset_batches()
-            avg_loss = avg_evidence = avg_latent = avg_generation = 0
-            for b in range(config.num_batches):
-                start = time.time()
-
-                # setup the feed dict
-                ev_data, n, e, y = reader.next_batch()
-                feed = {model.targets: y}
-                for j, ev in enumerate(config.evidence):
-                    feed[model.encoder.inputs[j].name] = ev_data[j]
-                for j in range(config.decoder.max_ast_depth):
-                    feed[model.decoder.nodes[j].name] = n[j]
-                    feed[model.decoder.edges[j].name] = e[j]
-
-                # run the optimizer
-                loss, evidence, latent, generation, mean, covariance, _ \
-                    = sess.run([model.loss,
-                                model.evidence_loss,
-                                model.latent_loss,
-                                model.gen_loss,
-                                model.encoder.psi_mean,
-                                model.encoder.psi_covariance,
-                                model.train_op], feed)
-                end = time.time()
-                avg_loss += np.mean(loss)
-                avg_evidence += np.mean(evidence)
-                avg_latent += np.mean(latent)
-                avg_generation += generation
-                step = i * config.num_batches + b
-                if step % config.print_step == 0:
-                    print('{}/{} (epoch {}), evidence: {:.3f}, latent: {:.3f}, generation: {:.3f}, '
-                          'loss: {:.3f}, mean: {:.3f}, covariance: {:.3f}, time: {:.3f}'.format
-                          (step, config.num_epochs * config.num_batches, i,
-                           np.mean(evidence),
-                           np.mean(latent),
-                           generation,
-                           np.mean(loss),
-                           np.mean(mean),
-                           np.mean(covariance),
-                           end - start))
-            checkpoint_dir = os.path.join(clargs.save, 'model.ckpt')
-            saver.save(sess, checkpoint_dir)
-            print('Model checkpointed: {}. Average for epoch evidence: {:.3f}, latent: {:.3f}, '
-                  'generation: {:.3f}, loss: {:.3f}'.format
-                  (checkpoint_dir,
-                   avg_evidence / config.num_batches,
-                   avg_latent / config.num_batches,
-                   avg_generation / config.num_batches,
-                   avg_loss / config.num_batches))
+    if server is None:
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            restore(sess)
+            yield sess
+        return
+
+    # the chief initializes (or restores) the variables on the parameter server while the others wait for it
+    is_chief = clargs.task_index == 0
+    sv = tf.train.Supervisor(is_chief=is_chief,
+                             init_op=tf.global_variables_initializer(),
+                             init_fn=restore,
+                             global_step=model.global_step,
+                             recovery_wait_secs=1)
+    threads = max(1, multiprocessing.cpu_count() // clargs.num_replicas)
+    # the managed session stops the supervisor's threads (and the chief's queue runner) on exit
+    with sv.managed_session(server.target, config=tf.ConfigProto(
+            intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)) as sess:
+        if is_chief:
+            sess.run(model.sync_init_op)
+            sv.start_queue_runners(sess, [model.chief_queue_runner])
+        yield sess
+
+
+def start_server(cluster, clargs):
+    try:
+        return tf.train.Server(cluster, job_name=clargs.job_name, task_index=clargs.task_index)
+    except tf.errors.UnknownError as e:  # gRPC could not bind the port, which another process took since launch
+        print('Could not start the {} server: {}'.format(clargs.job_name, e.message), file=sys.stderr)
+        sys.exit(PORT_IN_USE)
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def launch(clargs):
+    """Train data-parallel on this machine, with a parameter server and one worker process per replica.
+    Every worker reads its own shard of the (shared) cached data and gradients are averaged synchronously."""
+    with open(clargs.config if clargs.continue_from is None
+              else os.path.join(clargs.continue_from, 'config.json')) as f:
+        config = read_config(json.load(f), save_dir=clargs.save, infer=clargs.continue_from is not None)
+    Reader(clargs, config)  # preprocess the data once, into the cache the workers read from
+
+    # all workers must shuffle the same way for their shards to stay disjoint
+    seed = clargs.seed if clargs.seed is not None else np.random.randint(2 ** 31)
+    args = [sys.executable, '-m', 'bayou.core.train'] + sys.argv[1:] + ['--seed', str(seed)]
+
+    # a port found free may be taken by another process before the server binds it, so retry with other ports
+    for _ in range(LAUNCH_ATTEMPTS):
+        codes = run_cluster(args, clargs.num_replicas)
+        if codes is not None:
+            break
+        print('A port was taken before the cluster started, relaunching on other ports')
+    else:
+        sys.exit('Could not start the cluster in {} attempts'.format(LAUNCH_ATTEMPTS))
+    if any(codes):
+        sys.exit('Training failed in worker(s) {}'.format([i for i, c in enumerate(codes) if c]))
+
+
+def run_cluster(args, num_replicas):
+    """Run the parameter server and the workers on free ports until the workers finish, and return their exit codes,
+    or None if a process could not bind its port"""
+    ports = [free_port() for _ in range(num_replicas + 1)]
+    cluster = {'ps': ['localhost:{}'.format(ports[0])],
+               'worker': ['localhost:{}'.format(port) for port in ports[1:]]}
+    args = args + ['--cluster', json.dumps(cluster)]
+
+    ps = subprocess.Popen(args + ['--job_name', 'ps', '--task_index', '0'])
+    workers = [subprocess.Popen(args + ['--job_name', 'worker', '--task_index', str(i)])
+               for i in range(num_replicas)]
+    try:
+        # the workers wait for the parameter server forever, so watch it as well
+        while any(worker.poll() is None for worker in workers):
+            if ps.poll() is not None or any(worker.returncode for worker in workers):
+                break
+            time.sleep(1)
+        codes = [worker.poll() for worker in workers]
+        if ps.poll() == PORT_IN_USE or PORT_IN_USE in codes:
+            return None
+        if ps.poll() is not None:
+            sys.exit('Parameter server failed with exit code {}'.format(ps.returncode))
+        return codes
+    finally:
+        for proc in workers + [ps]:
+            if proc.poll() is None:
+                proc.terminate()
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -148,9 +389,58 @@ if __name__ == '__main__':
                         help='config file (see description above for help)')
     parser.add_argument('--continue_from', type=str, default=None,
                         help='ignore config options and continue training model checkpointed here')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='use (or create) preprocessed data in this directory (see data_reader.py)')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes to preprocess the data with')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for shuffling the data')
+    parser.add_argument('--prefetch', type=int, default=4,
+                        help='number of batches to prepare ahead in the background (0 to disable)')
+    parser.add_argument('--checkpoint_step', type=int, default=0,
+                        help='also checkpoint every given steps within an epoch (0 to checkpoint once per epoch)')
+    parser.add_argument('--keep', type=int, default=5,
+                        help='number of most recent checkpoints to keep (the best one is kept as best.ckpt)')
+    parser.add_argument('--validation_file', type=str, default=None,
+                        help='data file to evaluate the model on after every epoch')
+    parser.add_argument('--validation_split', type=float, default=0.,
+                        help='fraction of the programs in the input file to hold out for validation instead')
+    parser.add_argument('--patience', type=int, default=0,
+                        help='stop when the validation loss has not improved for this many epochs (0 to disable)')
+    parser.add_argument('--lr_patience', type=int, default=0,
+                        help='decay the learning rate when the validation loss has not improved for this many '
+                             'epochs (0 to disable)')
+    parser.add_argument('--lr_decay', type=float, default=0.5,
+                        help='factor to decay the learning rate by')
+    parser.add_argument('--print_interval', type=float, default=1.,
+                        help='print training output at most once in this many seconds')
+    parser.add_argument('--metrics_step', type=int, default=100,
+                        help='log throughput and resource usage to {} every given steps '
+                             '(0 to disable)'.format(METRICS))
+    parser.add_argument('--trace_from', type=int, default=0,
+                        help='first step to capture a timeline of (see --trace_steps)')
+    parser.add_argument('--trace_steps', type=int, default=0,
+                        help='number of steps to capture a timeline of, written to timeline-<step>.json '
+                             '(open in chrome://tracing)')
+    parser.add_argument('--num_replicas', type=int, default=1,
+                        help='train data-parallel with this many local worker processes (requires --cache_dir)')
+    parser.add_argument('--job_name', type=str, default=None, choices=['ps', 'worker'],
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--task_index', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--cluster', type=str, default=None,
+                        help=argparse.SUPPRESS)
     clargs = parser.parse_args()
     if clargs.config and clargs.continue_from:
         parser.error('Do not provide --config if you are continuing from checkpointed model')
     if not clargs.config and not clargs.continue_from:
         parser.error('Provide at least one option: --config or --continue_from')
+    if clargs.metrics_step < 0:
+        parser.error('--metrics_step must not be negative')
+    if clargs.num_replicas > 1 and clargs.cache_dir is None:
+        parser.error('Provide --cache_dir to share the preprocessed data between replicas')
+    if (clargs.patience or clargs.lr_patience) and not (clargs.validation_file or clargs.validation_split):
+        parser.error('Provide --validation_file or --validation_split for --patience and --lr_patience')
+    if (clargs.patience or clargs.lr_patience) and clargs.num_replicas > 1:
+        parser.error('--patience and --lr_patience are not supported in data-parallel training')
     train(clargs)
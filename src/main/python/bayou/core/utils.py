@@ -13,6 +13,7 @@
 # limitations under the License.
 
 from __future__ import print_function
+import numpy as np
 import argparse
 import re
 import json
@@ -20,6 +21,8 @@ import random
 from itertools import chain
 import tensorflow as tf
 
+from bayou.core.programs import read_programs, ProgramWriter, chunks, parallel_map
+
 CONFIG_GENERAL = ['latent_size', 'batch_size', 'num_epochs',
                   'learning_rate', 'print_step', 'alpha', 'beta']
 CONFIG_ENCODER = ['name', 'units', 'tile']
@@ -31,6 +34,9 @@ UNK = '_UNK_'
 CHILD_EDGE = 'V'
 SIBLING_EDGE = 'H'
 
+# variables that are rebuilt with the graph rather than trained (and so left out of checkpoints)
+UNSAVED_VARIABLES = 'unsaved_variables'
+
 
 def length(tensor):
     elems = tf.sign(tf.reduce_max(tensor, axis=2))
@@ -38,6 +44,12 @@ def length(tensor):
 
 
 # split s based on camel case and lower everything (uses '#' for split)
+def saved_variables():
+    """The global variables that are saved to and restored from checkpoints"""
+    unsaved = set(var.op.name for var in tf.get_collection(UNSAVED_VARIABLES))
+    return [var for var in tf.global_variables() if var.op.name not in unsaved]
+
+
 def split_camel(s):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1#\2', s)  # UC followed by LC
     s1 = re.sub('([a-z0-9])([A-Z])', r'\1#\2', s1)  # LC followed by UC
@@ -45,6 +57,95 @@ def split_camel(s):
     return [s.lower() for s in split]
 
 
+# Enumerate the paths of an AST, given the list of nodes of its DSubTree. Every path starts with the DSubTree
+# (child edge) and runs along sibling edges to a STOP, descending into a branch, except or loop along a child edge.
+# The paths are enumerated iteratively (in the same order as the recursive definition) on a single buffer, so that
+# paths share their prefix instead of copying it. Returns the paths flattened into arrays of node ids (through vocab,
+# a function from node names to ids that is called in order of appearance) and child edges, and the list of their
+# lengths. Raises AssertionError as soon as a path does not fit in max_depth.
+def ast_paths(nodes, max_depth, vocab):
+    index = {}  # node names numbered locally (from 1), mapped through vocab at the end
+
+    # the path along the siblings of a list of nodes, and the positions of the nodes with children
+    def spine(seq):
+        path = [index.setdefault(node['_call'] if node['node'] == 'DAPICall' else node['node'], len(index) + 1)
+                for node in seq]
+        path.append(index.setdefault('STOP', len(index) + 1))
+        return path, [i for i, node in enumerate(seq) if node['node'] != 'DAPICall']
+
+    buf_n, buf_e = [], []
+    flat_n, flat_e, lengths = [], [], []
+
+    # each task enumerates the paths of a list of nodes (or all but the first, along its siblings, which is
+    # already part of another path) after the prefix of the buffer of the given length followed by a segment
+    tasks = [(True, spine(nodes), nodes, 0, [index.setdefault('DSubTree', len(index) + 1)], [True])]
+    while tasks:
+        first, (path, children), seq, top, ids, edges = tasks.pop()
+        del buf_n[top:], buf_e[top:]
+        buf_n += ids
+        buf_e += edges
+        top = len(buf_n)
+        if first:
+            assert top + len(path) <= max_depth
+            lengths.append(top + len(path))
+            flat_n += buf_n
+            flat_n += path
+            flat_e += buf_e
+            flat_e += [False] * len(path)
+
+        # the paths descending from the last node with children come first
+        for i in children:
+            node = seq[i]
+            ids, edges = path[:i] + [index.setdefault(node['node'], len(index) + 1)], [False] * i + [True]
+            if node['node'] == 'DBranch':
+                cond, cond_children = spine(node['_cond'])
+                assert not cond_children
+                then = spine(node['_then'])
+                tasks.append((False, then, node['_then'], top, ids + cond, edges + [False] * len(cond)))
+                tasks.append((True, spine(node['_else']), node['_else'], top, ids + cond + then[0],
+                              edges + [False] * (len(cond) + len(then[0]))))
+            elif node['node'] == 'DExcept':
+                try_ = spine(node['_try'])
+                tasks.append((False, try_, node['_try'], top, ids, edges))
+                tasks.append((True, spine(node['_catch']), node['_catch'], top, ids + try_[0],
+                              edges + [False] * len(try_[0])))
+            elif node['node'] == 'DLoop':
+                cond, cond_children = spine(node['_cond'])
+                assert not cond_children
+                tasks.append((True, spine(node['_body']), node['_body'], top, ids + cond,
+                              edges + [False] * len(cond)))
+            else:
+                raise ValueError('Invalid node type: {}'.format(node['node']))
+
+    # map the local numbering through vocab, in order of appearance
+    labels = [None] + list(index)
+    lookup = np.zeros(len(labels), dtype=np.int32)
+    for i in dict.fromkeys(flat_n):
+        lookup[i] = vocab(labels[i])
+    return lookup[flat_n], np.array(flat_e, dtype=np.bool), lengths
+
+
+# scatter the paths of several ASTs (lists of what ast_paths returned for each) into arrays padded up to max_depth
+def pad_paths(flat_n, flat_e, lengths, max_depth):
+    lengths = np.array(list(chain.from_iterable(lengths)), dtype=np.int32)
+    return pad(np.concatenate(flat_n), lengths, max_depth), pad(np.concatenate(flat_e), lengths, max_depth), lengths
+
+
+# scatter sequences, flattened into a single array with the length of each, into rows padded with 0 up to max_length
+def pad(flat, lengths, max_length):
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    cols = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    padded = np.zeros((len(lengths), max_length), dtype=flat.dtype)
+    padded[rows, cols] = flat
+    return padded
+
+
+# map a sequence of tokens to ids through vocab, looking up each distinct token only once
+def lookup_tokens(tokens, vocab):
+    distinct, inverse = np.unique(np.array(tokens, dtype=object), return_inverse=True)
+    return np.array([vocab[token] for token in distinct], dtype=np.int32)[inverse]
+
+
 # Do not move these imports to the top, it will introduce a cyclic dependency
 import bayou.core.evidence
 
@@ -82,27 +183,51 @@ def dump_config(config):
 
 
 HELP = """Use this to extract evidences from a raw data file with sequences generated by driver.
-You can also filter programs based on number and length of sequences, and control the samples from each program."""
+You can also filter programs based on number and length of sequences, and control the samples from each program.
+The output file is written as the programs are processed (in JSON-lines format if its name ends with .jsonl)."""
 
+EXTRACT_CHUNK_SIZE = 1000  # number of programs sent to a worker process at a time
 
-def extract_evidence(clargs):
-    print('Loading data file...', end='')
-    with open(clargs.input_file[0]) as f:
-        js = json.load(f)
-    print('done')
+_extract_clargs, _extract_seed = None, None  # the options of each worker process
+_call_evidences = {}  # memoized evidences of each call seen by a worker process
+
+
+def _init_extract(clargs, seed):
+    global _extract_clargs, _extract_seed
+    _extract_clargs, _extract_seed = clargs, seed
+
+
+def _call_evidence(call):
+    try:
+        return _call_evidences[call]
+    except KeyError:
+        evidence = (bayou.core.evidence.APICalls.from_call(call),
+                    bayou.core.evidence.Types.from_call(call),
+                    bayou.core.evidence.Context.from_call(call))
+        _call_evidences[call] = evidence
+        return evidence
+
+
+# extract the evidences of a chunk of programs, returning the number of programs kept and the programs (or samples)
+# to write. The samples are drawn from a generator seeded with the chunk number, so they do not depend on the worker.
+def _extract_chunk(item):
+    number, chunk = item
+    clargs = _extract_clargs
+    rng = random.Random(_extract_seed * 1000003 + number)
     done = 0
     programs = []
-    for program in js['programs']:
+    for program in chunk:
         sequences = program['sequences']
         if len(sequences) > clargs.max_seqs or \
                 any([len(sequence['calls']) > clargs.max_seq_length for sequence in sequences]):
             continue
 
         calls = set(chain.from_iterable([sequence['calls'] for sequence in sequences]))
+        evidences = [_call_evidence(call) for call in calls]
 
-        apicalls = list(set(chain.from_iterable([bayou.core.evidence.APICalls.from_call(call) for call in calls])))
-        types = list(set(chain.from_iterable([bayou.core.evidence.Types.from_call(call) for call in calls])))
-        context = list(set(chain.from_iterable([bayou.core.evidence.Context.from_call(call) for call in calls])))
+        apicalls = sorted(set(chain.from_iterable([evidence[0] for evidence in evidences])))
+        types = sorted(set(chain.from_iterable([evidence[1] for evidence in evidences])))
+        context = sorted(set(chain.from_iterable([evidence[2] for evidence in evidences])))
 
         if clargs.num_samples == 0:
             program['apicalls'] = apicalls
@@ -114,18 +239,27 @@ def extract_evidence(clargs):
                 sample = dict(program)
                 sample['apicalls'], sample['types'], sample['context'] = [], [], []
                 while sample['apicalls'] == [] and sample['types'] == [] and sample['context'] == []:
-                    sample['apicalls'] = random.sample(apicalls, random.choice(range(len(apicalls) + 1)))
-                    sample['types'] = random.sample(types, random.choice(range(len(types) + 1)))
-                    sample['context'] = random.sample(context, random.choice(range(len(context) + 1)))
+                    sample['apicalls'] = rng.sample(apicalls, rng.choice(range(len(apicalls) + 1)))
+                    sample['types'] = rng.sample(types, rng.choice(range(len(types) + 1)))
+                    sample['context'] = rng.sample(context, rng.choice(range(len(context) + 1)))
                 programs.append(sample)
 
         done += 1
-        print('Extracted evidence for {} programs'.format(done), end='\r')
+    return done, programs
 
-    print('\nWriting to {}...'.format(clargs.output_file[0]), end='')
-    with open(clargs.output_file[0], 'w') as f:
-        json.dump({'programs': programs}, fp=f, indent=2)
-    print('done')
+
+def extract_evidence(clargs):
+    seed = clargs.seed if clargs.seed is not None else random.randrange(1 << 30)
+    done = 0
+    with ProgramWriter(clargs.output_file[0]) as writer:
+        items = enumerate(chunks(read_programs(clargs.input_file[0]), EXTRACT_CHUNK_SIZE))
+        for extracted, programs in parallel_map(_extract_chunk, items, clargs.num_workers,
+                                                initializer=_init_extract, initargs=(clargs, seed)):
+            for program in programs:
+                writer.write(program)
+            done += extracted
+            print('Extracted evidence for {} programs'.format(done), end='\r')
+    print('\nWrote {} programs to {}'.format(writer.count, clargs.output_file[0]))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -140,5 +274,9 @@ if __name__ == '__main__':
                         help='maximum length of each sequence in a program')
     parser.add_argument('--num_samples', type=int, default=0,
                         help='number of samples of evidences per program')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes to extract evidences with')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for sampling evidences')
     clargs = parser.parse_args()
     extract_evidence(clargs)
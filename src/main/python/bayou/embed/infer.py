@@ -12,45 +12,40 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
+import numpy as np
 import tensorflow as tf
 import argparse
 import json
 import os
-from sklearn.manifold import TSNE
 from matplotlib import pylab
 
 from bayou.embed.utils import read_config
+from bayou.embed import projection
 
 
 def infer(clargs):
     with open(os.path.join(clargs.save, 'config.json')) as f:
         config = read_config(json.load(f), True)
+    num_points = min(clargs.num_points, config.vocab_size)
 
-    with tf.Session() as sess:
-        embedding = tf.get_variable('embedding', [config.vocab_size, config.embedding_size], 
-                                    dtype=tf.float32, trainable=False)
-        norm = tf.sqrt(tf.reduce_sum(tf.square(embedding), 1, keep_dims=True))
-        normalized_embedding = embedding / norm
+    # the embedding is read directly from the checkpoint, and only if the projection is not cached
+    checkpoint = tf.train.get_checkpoint_state(clargs.save).model_checkpoint_path
 
-        saver = tf.train.Saver({'embedding': embedding})
-        ckpt = tf.train.get_checkpoint_state(clargs.save)
-        saver.restore(sess, ckpt.model_checkpoint_path)
-        final_embedding = normalized_embedding.eval()
+    def normalized_embedding():
+        embedding = tf.train.NewCheckpointReader(checkpoint).get_tensor('embedding')[:num_points]
+        return embedding / np.sqrt(np.sum(np.square(embedding), axis=1, keepdims=True))
 
-    tsne = TSNE(perplexity=30, n_components=2, init='pca', n_iter=5000)
-    two_d_embeddings = tsne.fit_transform(final_embedding[:clargs.num_points, :])
-    words = [config.chars[i] for i in range(clargs.num_points)]
-    plot(two_d_embeddings, words, clargs.out)
+    two_d_embeddings = projection.cached_projection(normalized_embedding, clargs, checkpoint,
+                                                    clargs.cache_dir or clargs.save, num_points=num_points)
+    words = config.chars[:num_points]
+    plot(two_d_embeddings, words, clargs.out, clargs.num_labels)
 
 
-def plot(embeddings, labels, out):
+def plot(embeddings, labels, out, num_labels):
     assert embeddings.shape[0] >= len(labels), 'More labels than embeddings'
     pylab.figure(figsize=(15,15))
-    for i, label in enumerate(labels):
-        x, y = embeddings[i,:]
-        pylab.scatter(x, y)
-        pylab.annotate(label, xy=(x, y), xytext=(5, 2), textcoords='offset points',
-                       ha='right', va='bottom')
+    projection.scatter(pylab.gca(), embeddings, labels=labels, max_labels=num_labels, size=20)
     pylab.savefig(out)
     print('Saved plot to {}'.format(out))
 
@@ -60,7 +55,11 @@ if __name__ == '__main__':
                         help='directory to load model from')
     parser.add_argument('--num_points', type=int, default=500,
                         help='number of top-k words to plot')
+    parser.add_argument('--num_labels', type=int, default=500,
+                        help='number of top-k words to label in the plot')
     parser.add_argument('--out', type=str, default='plot.png',
                         help='output .png file to save plot to')
+    projection.add_arguments(parser)
+    parser.set_defaults(tsne_iter=5000)
     clargs = parser.parse_args()
     infer(clargs)
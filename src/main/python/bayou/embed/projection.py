@@ -0,0 +1,101 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import numpy as np
+import hashlib
+import json
+import os
+
+METHODS = ['tsne', 'pca']
+PRE_REDUCTIONS = ['none', 'pca', 'random']
+
+
+def add_arguments(parser):
+    """Add the options of the 2-D projection to an argument parser"""
+    parser.add_argument('--method', choices=METHODS, default='tsne',
+                        help='projection to 2-D')
+    parser.add_argument('--pre_reduce', choices=PRE_REDUCTIONS, default='pca',
+                        help='cheap reduction of the vectors before t-SNE')
+    parser.add_argument('--pre_dims', type=int, default=50,
+                        help='number of dimensions to pre-reduce to')
+    parser.add_argument('--tsne_iter', type=int, default=1000,
+                        help='number of t-SNE iterations')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed for subsampling and projecting')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='directory to cache projections in (by default, the model directory)')
+
+
+def reduce(vectors, dims, method, rng):
+    """Reduce vectors to (at most) dims dimensions with PCA or a Gaussian random projection"""
+    if method == 'none' or vectors.shape[1] <= dims:
+        return vectors
+    centered = vectors - np.mean(vectors, axis=0)
+    if method == 'pca':
+        # principal axes from the (small) covariance matrix, rather than an SVD of all vectors
+        _, axes = np.linalg.eigh(np.dot(centered.T, centered))
+        return np.dot(centered, axes[:, ::-1][:, :dims])
+    projection = rng.normal(size=(vectors.shape[1], dims)) / np.sqrt(dims)
+    return np.dot(centered, projection)
+
+
+def project(vectors, clargs):
+    """Project vectors to 2-D with the method and pre-reduction in clargs"""
+    vectors = np.asarray(vectors, dtype=np.float64)
+    rng = np.random.RandomState(clargs.seed)
+    if clargs.method == 'pca':
+        return reduce(vectors, 2, 'pca', rng)
+    from sklearn.manifold import TSNE
+    vectors = reduce(vectors, clargs.pre_dims, clargs.pre_reduce, rng)
+    tsne = TSNE(perplexity=min(30, max(len(vectors) - 1, 1) / 3.), n_components=2, init='pca',
+                n_iter=clargs.tsne_iter, random_state=clargs.seed)
+    return tsne.fit_transform(vectors)
+
+
+def cached_projection(vectors, clargs, checkpoint, cache_dir, **key):
+    """Project vectors to 2-D (see project), caching the result in cache_dir. The cache is keyed by the checkpoint
+    the vectors were computed with (and the time it was written), the projection options and the given key, which
+    should identify the vectors (e.g., the data file and the points sampled from it)."""
+    key = dict(key, checkpoint=os.path.abspath(checkpoint),
+               checkpoint_time=max(os.path.getmtime(path) for path in _checkpoint_files(checkpoint)),
+               method=clargs.method, pre_reduce=clargs.pre_reduce, pre_dims=clargs.pre_dims,
+               tsne_iter=clargs.tsne_iter, seed=clargs.seed)
+    digest = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+    cache = os.path.join(cache_dir, 'projection-{}.npy'.format(digest[:16]))
+    if os.path.exists(cache):
+        print('Loaded projection from {}'.format(cache))
+        return np.load(cache)
+    points = project(vectors() if callable(vectors) else vectors, clargs)
+    try:
+        np.save(cache, points)
+    except IOError:  # the cache is only an optimization
+        pass
+    return points
+
+
+def _checkpoint_files(checkpoint):
+    # a checkpoint is a single file (V1) or an index with data files (V2)
+    directory, prefix = os.path.split(os.path.abspath(checkpoint))
+    files = [os.path.join(directory, name) for name in os.listdir(directory)
+             if name == prefix or name.startswith(prefix + '.')]
+    return files or [checkpoint]
+
+
+def scatter(ax, points, colors=None, labels=None, max_labels=0, size=4):
+    """Plot all points with a single scatter call, annotating (at most) the first max_labels of them"""
+    ax.scatter(points[:, 0], points[:, 1], c=colors, s=size, linewidths=0)
+    if labels is not None:
+        for (x, y), label in zip(points[:max_labels], labels[:max_labels]):
+            ax.annotate(label, xy=(x, y), xytext=(5, 2), textcoords='offset points', ha='right', va='bottom')
@@ -18,14 +18,14 @@ import numpy as np
 import argparse
 import textwrap
 import os
-import collections
+import array
 from itertools import chain
 import json
 import math
 import time
 
 from bayou.embed.utils import read_config, dump_config
-from bayou.core.utils import C0, UNK
+from bayou.core.utils import C0, UNK, read_programs
 
 HELP = """\
 Config options should be given as a JSON file (see config.json for example):
@@ -36,47 +36,74 @@ Config options should be given as a JSON file (see config.json for example):
     "batch_size": 50,        | Minibatch size
     "num_epochs": 100,       | Number of training epochs
     "learning_rate": 1.0,    | Learning rate
-    "print_step": 1          | Print training output every given steps
+    "print_step": 1,         | Print training output every given steps
+    "subsample": 0,          | (Optional) Threshold for subsampling frequent words, e.g. 1e-5 (0 to disable)
+    "dynamic_window": false  | (Optional) Sample the window size of each word uniformly from 1 to window_size
 }                            |
 """
 
+BLOCK_SIZE = 1 << 16  # number of words whose skip-grams are generated (and shuffled) together
 
-def get_data_javadoc(js):
-    data = []
-    for program in js['programs']:
+
+# read the javadocs of the programs as the ids (in order of appearance) of their words all concatenated, the offsets
+# at which each javadoc starts (and the end), and the words
+def get_data_javadoc(input_file):
+    words, ids, offsets = {}, array.array('i'), [0]
+    for program in read_programs(input_file):
         javadoc = program['javadoc'] if 'javadoc' in program else None
         if javadoc:
-            data.append(javadoc.split())
-    return data
-
-
-def to_skip_grams(data, window_size):
-    inputs, targets = [], []
-    for point in data:
-        for i, word in enumerate(point):
-            left = max(i - window_size, 0)
-            right = min(i + window_size + 1, len(point))
-            window = list(range(left, right))
-            if i in window:
-                window.remove(i)
-            for j in window:
-                inputs.append(word)
-                targets.append(point[j])
-    return inputs, targets
-
-
-def wrangle(raw_inputs, raw_targets, config):
-    sz = config.num_batches * config.batch_size
-    raw_inputs = raw_inputs[:sz]
-    raw_targets = raw_targets[:sz]
-
-    inputs = np.array(list(map(config.vocab.get, raw_inputs)))
-    targets = np.array(list(map(config.vocab.get, raw_targets)))
-
-    inputs = np.split(inputs, config.num_batches)
-    targets = np.split(np.reshape(targets, [-1, 1]), config.num_batches)
-
-    return inputs, targets
+            ids.extend(words.setdefault(word, len(words)) for word in javadoc.split())
+            offsets.append(len(ids))
+    return np.frombuffer(ids, dtype=np.int32), np.array(offsets, dtype=np.int64), list(words)
+
+
+# number of skip-gram pairs of each word, without subsampling or dynamic windows
+def count_skip_grams(offsets, window_size):
+    lengths = np.diff(offsets)
+    docs = np.repeat(np.arange(len(lengths)), lengths)
+    positions = np.arange(offsets[-1]) - offsets[:-1][docs]
+    return np.minimum(positions, window_size) + np.minimum(lengths[docs] - 1 - positions, window_size)
+
+
+# generate the (input, target) skip-gram pairs of an epoch, in blocks of consecutive words taken in random order and
+# shuffled within. Frequent words are first discarded with probability 1 - keep[word] (the windows then span over
+# them, as in word2vec), and with dynamic windows each word gets a window size from 1 to window_size.
+def skip_grams(ids, offsets, keep, config, rng):
+    docs = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    if keep is not None:
+        kept = rng.random_sample(len(ids)) < keep[ids]
+        ids, docs = ids[kept], docs[kept]
+    n = len(ids)
+    starts = np.arange(0, n, BLOCK_SIZE)
+    rng.shuffle(starts)
+    for start in starts:
+        positions = np.arange(start, min(start + BLOCK_SIZE, n))
+        if config.dynamic_window:
+            windows = rng.randint(1, config.window_size + 1, len(positions))
+        inputs, targets = [], []
+        for offset in chain(range(-config.window_size, 0), range(1, config.window_size + 1)):
+            context = np.clip(positions + offset, 0, n - 1)
+            valid = (context == positions + offset) & (docs[context] == docs[positions])
+            if config.dynamic_window:
+                valid &= abs(offset) <= windows
+            inputs.append(ids[positions[valid]])
+            targets.append(ids[context[valid]])
+        inputs, targets = np.concatenate(inputs), np.concatenate(targets)
+        order = rng.permutation(len(inputs))
+        yield inputs[order], targets[order]
+
+
+# stream the skip-gram pairs of an epoch in minibatches (the last, incomplete one is dropped)
+def batches(ids, offsets, keep, config, rng):
+    rest_inputs, rest_targets = ids[:0], ids[:0]
+    for inputs, targets in skip_grams(ids, offsets, keep, config, rng):
+        inputs, targets = np.concatenate([rest_inputs, inputs]), np.concatenate([rest_targets, targets])
+        num_batches = len(inputs) // config.batch_size
+        for j in range(num_batches):
+            batch = slice(j * config.batch_size, (j + 1) * config.batch_size)
+            yield inputs[batch], np.reshape(targets[batch], [-1, 1])
+        rest_inputs = inputs[num_batches * config.batch_size:]
+        rest_targets = targets[num_batches * config.batch_size:]
 
 
 def model(config):
@@ -102,39 +129,46 @@ def model(config):
 def train(clargs):
     with open(clargs.config) as f:
         config = read_config(json.load(f), False)
-    with open(clargs.input_file[0]) as f:
-        js = json.load(f)
 
-    data = get_data_javadoc(js)
+    ids, offsets, words = get_data_javadoc(clargs.input_file[0])
 
-    chars = collections.Counter(chain.from_iterable(data))
+    # vocabulary, by decreasing frequency (ties in order of appearance)
+    chars = dict(zip(words, np.bincount(ids, minlength=len(words)).tolist()))
     chars[C0] = 1
     chars[UNK] = 1
     config.chars = sorted(chars.keys(), key=lambda c: -chars[c])
     config.vocab = dict(zip(config.chars, range(len(config.chars))))
     config.vocab_size = len(config.vocab)
+    ids = np.array([config.vocab[word] for word in words], dtype=np.int32)[ids]
 
     jsconfig = dump_config(config)
     with open(os.path.join(clargs.save, 'config.json'), 'w') as f:
         json.dump(jsconfig, fp=f, indent=2)
 
-    raw_inputs, raw_targets = to_skip_grams(data, config.window_size)
-    config.num_batches = int(len(raw_inputs) / config.batch_size)
+    # probability of keeping each word when subsampling, as in word2vec
+    keep = None
+    if config.subsample > 0:
+        freq = np.bincount(ids, minlength=config.vocab_size) / float(max(len(ids), 1))
+        ratio = config.subsample / np.maximum(freq, 1e-12)
+        keep = np.minimum(np.sqrt(ratio) + ratio, 1.)
+
+    num_pairs = int(np.sum(count_skip_grams(offsets, config.window_size)))
+    config.num_batches = num_pairs // config.batch_size
     assert config.num_batches > 0, 'Not enough data'
-    inputs, targets = wrangle(raw_inputs, raw_targets, config)
-    print('Training data: {} pairs, {} batches, {} vocab size'.format
-          (len(raw_inputs), len(inputs), config.vocab_size))
+    print('Training data: {} pairs, {} batches, {} vocab size{}'.format(
+          num_pairs, config.num_batches, config.vocab_size,
+          ' (before subsampling and dynamic windows)' if keep is not None or config.dynamic_window else ''))
 
     tf_inputs, tf_targets, loss, optimizer = model(config)
+    rng = np.random.RandomState(clargs.seed)
 
     with tf.Session() as sess:
         tf.global_variables_initializer().run()
         saver = tf.train.Saver(tf.global_variables())
         sum_cost = 0
         for i in range(config.num_epochs):
-            for j in range(config.num_batches):
+            for j, (batch_inputs, batch_targets) in enumerate(batches(ids, offsets, keep, config, rng)):
                 start = time.time()
-                batch_inputs, batch_targets = inputs[j], targets[j]
                 feed = { tf_inputs: batch_inputs, tf_targets: batch_targets }
                 _, cost = sess.run([optimizer, loss], feed_dict=feed)
                 end = time.time()
@@ -157,5 +191,7 @@ if __name__ == '__main__':
                         help='config file (see description above for help)')
     parser.add_argument('--save', type=str, default='save',
                         help='checkpoint model during training here')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='random seed for shuffling and subsampling the skip-grams')
     clargs = parser.parse_args()
     train(clargs)
@@ -17,6 +17,7 @@ import argparse
 CONFIG_GENERAL = ['embedding_size', 'window_size', 'num_sampled',
                   'batch_size', 'num_epochs', 'learning_rate', 'print_step']
 CONFIG_CHARS_VOCAB = ['chars', 'vocab', 'vocab_size']
+CONFIG_OPTIONAL = {'subsample': 0., 'dynamic_window': False}  # with their defaults, for older config files
 
 
 # convert JSON to config
@@ -24,6 +25,8 @@ def read_config(js, chars_vocab):
     config = argparse.Namespace()
     for attr in CONFIG_GENERAL:
         config.__setattr__(attr, js[attr])
+    for attr, default in CONFIG_OPTIONAL.items():
+        config.__setattr__(attr, js.get(attr, default))
     if chars_vocab:
         for attr in CONFIG_CHARS_VOCAB:
             config.__setattr__(attr, js[attr])
@@ -36,6 +39,8 @@ def dump_config(config):
     js = {}
     for attr in CONFIG_GENERAL:
         js[attr] = config.__getattribute__(attr)
+    for attr in CONFIG_OPTIONAL:
+        js[attr] = config.__getattribute__(attr)
     for attr in CONFIG_CHARS_VOCAB:
         js[attr] = config.__getattribute__(attr)
 
@@ -12,57 +12,80 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import json
+from __future__ import print_function
+import os
 import argparse
 import numpy as np
 import tensorflow as tf
-from sklearn.manifold import TSNE
 
 from bayou.core.infer import BayesianPredictor
+from bayou.core.programs import read_programs, chunks
+from bayou.embed import projection
 
 
 def plot(clargs):
+    programs = sample_programs(clargs.input_file[0], clargs.num_points, clargs.seed)
+    labels = np.array([sorted(program['types'])[0] for program in programs], dtype=object)
+    print('Plotting {} programs'.format(len(programs)))
+
     with tf.Session() as sess:
         predictor = BayesianPredictor(clargs.save, sess)
-        with open(clargs.input_file[0]) as f:
-            js = json.load(f)
-        psis = np.array([predictor.psi_from_evidence(program)[0] for program in js['programs']])
-        model = TSNE(n_components=2, init='pca')
-        psis_2d = model.fit_transform(psis)
-        labels = [sorted(program['types'])[0] for program in js['programs']]
+        checkpoint = tf.train.get_checkpoint_state(clargs.save).model_checkpoint_path
+
+        # psi is computed in batches, and only if the projection is not cached
+        def psis():
+            return np.concatenate([predictor.psi_from_evidence_batch(batch)
+                                   for batch in chunks(programs, clargs.batch_size)])
+
+        input_file = os.path.abspath(clargs.input_file[0])
+        psis_2d = projection.cached_projection(psis, clargs, checkpoint, clargs.cache_dir or clargs.save,
+                                               input_file=input_file, input_time=os.path.getmtime(input_file),
+                                               num_points=clargs.num_points)
         assert len(psis_2d) == len(labels)
+    scatter(clargs, psis_2d, labels)
+
 
-        for psi_2d, label in zip(psis_2d, labels):
-            print('{} : {}'.format(psi_2d, label))
-        scatter(clargs, zip(psis_2d, labels))
+# read the programs in the input file, or a uniform sample of num_points of them (in the order of the file)
+def sample_programs(input_file, num_points, seed):
+    if num_points <= 0:
+        return list(read_programs(input_file))
+    rng = np.random.RandomState(seed)
+    sample = []
+    for i, program in enumerate(read_programs(input_file)):
+        if i < num_points:
+            sample.append((i, program))
+        else:
+            j = rng.randint(0, i + 1)
+            if j < num_points:
+                sample[j] = (i, program)
+    return [program for _, program in sorted(sample, key=lambda s: s[0])]
 
 
-def scatter(clargs, data):
+def scatter(clargs, psis_2d, labels):
     import matplotlib.pyplot as plt
     import matplotlib.cm as cm
-    dic = {}
-    for psi_2d, label in data:
-        if label not in dic:
-            dic[label] = []
-        dic[label].append(psi_2d)
 
-    labels = list(dic.keys())
-    labels.sort(key=lambda l: len(dic[l]), reverse=True)
-    for label in labels[clargs.top:]:
-        del dic[label]
+    # keep only the points of the top-k labels (by number of points), plotted all at once
+    top, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    order = np.argsort(-counts, kind='mergesort')[:clargs.top]
+    rank = np.full(len(top), -1)
+    rank[order] = np.arange(len(order))
+    ranks = rank[inverse]
+    shown = ranks >= 0
 
-    labels = dic.keys()
-    colors = cm.rainbow(np.linspace(0, 1, len(dic)))
-    plotpoints = []
-    for label, color in zip(labels, colors):
-        x = list(map(lambda s: s[0], dic[label]))
-        y = list(map(lambda s: s[1], dic[label]))
-        plotpoints.append(plt.scatter(x, y, color=color))
+    colors = cm.rainbow(np.linspace(0, 1, len(order)))
+    projection.scatter(plt.gca(), psis_2d[shown], colors=colors[ranks[shown]], size=clargs.point_size)
 
-    plt.legend(plotpoints, labels, scatterpoints=1, loc='lower left', ncol=3, fontsize=12)
+    # the legend needs one (empty) plot per label
+    plotpoints = [plt.scatter([], [], color=color) for color in colors]
+    plt.legend(plotpoints, top[order], scatterpoints=1, loc='lower left', ncol=3, fontsize=12)
     plt.axhline(0, color='black')
     plt.axvline(0, color='black')
-    plt.show()
+    if clargs.out is not None:
+        plt.savefig(clargs.out)
+        print('Saved plot to {}'.format(clargs.out))
+    else:
+        plt.show()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -72,5 +95,14 @@ if __name__ == '__main__':
                         help='directory to load model from')
     parser.add_argument('--top', type=int, default=10,
                         help='plot only the top-k labels')
+    parser.add_argument('--num_points', type=int, default=0,
+                        help='plot a random sample of this many programs (0 for all)')
+    parser.add_argument('--batch_size', type=int, default=8192,
+                        help='number of programs whose psi is computed at once')
+    parser.add_argument('--point_size', type=float, default=4,
+                        help='size of the points in the plot')
+    parser.add_argument('--out', type=str, default=None,
+                        help='save the plot to this file instead of showing it')
+    projection.add_arguments(parser)
     clargs = parser.parse_args()
     plot(clargs)
@@ -19,6 +19,7 @@ import random
 from collections import Counter
 
 from bayou.experiments.low_level_evidences.utils import C0, CHILD_EDGE, SIBLING_EDGE
+from bayou.core.utils import ast_paths, pad, lookup_tokens
 
 
 class Reader():
@@ -51,13 +52,13 @@ class Reader():
 
         # wrangle the evidences and targets into numpy arrays
         self.inputs = [ev.wrangle(data) for ev, data in zip(config.evidence, raw_evidences)]
-        self.nodes = np.zeros((sz, config.decoder.max_ast_depth), dtype=np.int32)
-        self.edges = np.zeros((sz, config.decoder.max_ast_depth), dtype=np.bool)
-        self.targets = np.zeros((sz, config.decoder.max_ast_depth), dtype=np.int32)
-        for i, path in enumerate(raw_targets):
-            self.nodes[i, :len(path)] = list(map(config.decoder.vocab.get, [p[0] for p in path]))
-            self.edges[i, :len(path)] = [p[1] == CHILD_EDGE for p in path]
-            self.targets[i, :len(path)-1] = self.nodes[i, 1:len(path)]  # shifted left by one
+        # (the paths are flattened, mapped through the vocab at once and scattered into the padded arrays)
+        lengths = np.array([len(path) for path in raw_targets], dtype=np.int32)
+        names, edges = zip(*[p for path in raw_targets for p in path])
+        self.nodes = pad(lookup_tokens(names, config.decoder.vocab), lengths, config.decoder.max_ast_depth)
+        self.edges = pad(np.array(edges) == CHILD_EDGE, lengths, config.decoder.max_ast_depth)
+        self.targets = np.zeros_like(self.nodes)
+        self.targets[:, :-1] = self.nodes[:, 1:]  # shifted left by one
 
         # split into batches
         self.inputs = [np.split(ev_data, config.num_batches, axis=0) for ev_data in self.inputs]
@@ -68,48 +69,17 @@ class Reader():
         # reset batches
         self.reset_batches()
 
-    def get_ast_paths(self, js, idx=0):
-        cons_calls = []
-        i = idx
-        while i < len(js):
-            if js[i]['node'] == 'DAPICall':
-                cons_calls.append((js[i]['_call'], SIBLING_EDGE))
-            else:
-                break
-            i += 1
-        if i == len(js):
-            cons_calls.append(('STOP', SIBLING_EDGE))
-            return [cons_calls]
-        node_type = js[i]['node']
-
-        if node_type == 'DBranch':
-            pC = self.get_ast_paths(js[i]['_cond'])  # will have at most 1 "path"
-            assert len(pC) <= 1
-            p1 = self.get_ast_paths(js[i]['_then'])
-            p2 = self.get_ast_paths(js[i]['_else'])
-            p = [p1[0] + path for path in p2] + p1[1:]
-            pv = [cons_calls + [('DBranch', CHILD_EDGE)] + pC[0] + path for path in p]
-            p = self.get_ast_paths(js, i+1)
-            ph = [cons_calls + [('DBranch', SIBLING_EDGE)] + path for path in p]
-            return ph + pv
-
-        if node_type == 'DExcept':
-            p1 = self.get_ast_paths(js[i]['_try'])
-            p2 = self.get_ast_paths(js[i]['_catch'])
-            p = [p1[0] + path for path in p2] + p1[1:]
-            pv = [cons_calls + [('DExcept', CHILD_EDGE)] + path for path in p]
-            p = self.get_ast_paths(js, i+1)
-            ph = [cons_calls + [('DExcept', SIBLING_EDGE)] + path for path in p]
-            return ph + pv
-
-        if node_type == 'DLoop':
-            pC = self.get_ast_paths(js[i]['_cond'])  # will have at most 1 "path"
-            assert len(pC) <= 1
-            p = self.get_ast_paths(js[i]['_body'])
-            pv = [cons_calls + [('DLoop', CHILD_EDGE)] + pC[0] + path for path in p]
-            p = self.get_ast_paths(js, i+1)
-            ph = [cons_calls + [('DLoop', SIBLING_EDGE)] + path for path in p]
-            return ph + pv
+    def get_ast_paths(self, js):
+        """Paths of the AST (see bayou.core.utils.ast_paths) as lists of (node, edge), starting from the DSubTree"""
+        names = []
+        n, e, lengths = ast_paths(js, self.config.decoder.max_ast_depth, lambda c: names.append(c) or len(names))
+        n, e = n.tolist(), e.tolist()
+        paths, start = [], 0
+        for length in lengths:
+            paths.append([(names[i - 1], CHILD_EDGE if edge else SIBLING_EDGE)
+                          for i, edge in zip(n[start:start + length], e[start:start + length])])
+            start += length
+        return paths
 
     def read_data(self, filename):
         with open(filename) as f:
@@ -122,10 +92,7 @@ class Reader():
                 continue
             try:
                 evidence = [ev.read_data_point(program) for ev in self.config.evidence]
-                ast_paths = self.get_ast_paths(program['ast']['_nodes'])
-                for path in ast_paths:
-                    path.insert(0, ('DSubTree', CHILD_EDGE))
-                    assert len(path) <= self.config.decoder.max_ast_depth
+                for path in self.get_ast_paths(program['ast']['_nodes']):
                     evidences.append(evidence)
                     targets.append(path)
             except AssertionError:
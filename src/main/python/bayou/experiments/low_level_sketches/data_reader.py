@@ -19,6 +19,7 @@ import random
 from collections import Counter
 
 from bayou.experiments.low_level_sketches.utils import C0
+from bayou.core.utils import pad, lookup_tokens
 
 
 class Reader():
@@ -49,11 +50,12 @@ class Reader():
 
         # wrangle the evidences and targets into numpy arrays
         self.inputs = [ev.wrangle(data) for ev, data in zip(config.evidence, raw_evidences)]
-        self.tokens = np.zeros((sz, config.decoder.max_tokens), dtype=np.int32)
-        self.targets = np.zeros((sz, config.decoder.max_tokens), dtype=np.int32)
-        for i, tokens in enumerate(raw_targets):
-            self.tokens[i, :len(tokens)] = list(map(config.decoder.vocab.get, tokens))
-            self.targets[i, :len(tokens)-1] = self.tokens[i, 1:len(tokens)]  # shifted left by one
+        # (the tokens are flattened, mapped through the vocab at once and scattered into the padded arrays)
+        lengths = np.array([len(tokens) for tokens in raw_targets], dtype=np.int32)
+        tokens = [token for tokens in raw_targets for token in tokens]
+        self.tokens = pad(lookup_tokens(tokens, config.decoder.vocab), lengths, config.decoder.max_tokens)
+        self.targets = np.zeros_like(self.tokens)
+        self.targets[:, :-1] = self.tokens[:, 1:]  # shifted left by one
 
         # split into batches
         self.inputs = [np.split(ev_data, config.num_batches, axis=0) for ev_data in self.inputs]
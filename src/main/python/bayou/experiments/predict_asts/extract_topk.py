@@ -12,56 +12,66 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
 import argparse
+import hashlib
+import heapq
 import json
 
+from bayou.core.programs import read_programs
+
 # Use this to extract the top-k distant programs from the testing data set,
-# match them with the programs in one of the variational-* or encdec-* files
+# match them with the programs in one or more of the variational-* or encdec-* files
 # (because those files do not have distance info) and generate a new (sub)set
 # of variational-* and encdec-* files.
 
+
 def extract_topk(args):
+    assert len(args.predict_asts_output) == len(args.output_file), 'Need one output file per predict_asts output'
     with open(args.testing_with_dists[0]) as f:
         js = json.load(f)
-    programs = sorted(js['programs'], key=lambda p: -p['corpus_dist'])
+    keys = [ast_key(program['ast']) for program in js['programs']]
+    dists = [program['corpus_dist'] for program in js['programs']]
+
+    for predict_asts_output, output_file in zip(args.predict_asts_output, args.output_file):
+        # for each program, check if there's a matching one in the provided JSON
+        # (there HAS to be one if the program was tested on)
+        index = build_index(predict_asts_output, set(keys))
+        matches = [(i, index[key]) for i, key in enumerate(keys) if key in index]
+        print('Matches found for {}/{} programs in {}'.format(len(matches), len(keys), predict_asts_output))
+
+        # do the top-k (ties in the order of the testing data)
+        top = heapq.nsmallest(args.k, matches, key=lambda m: (-dists[m[0]], m[0]))
+        output_programs = [dict(program, corpus_dist=dists[i]) for i, program in top]
+
+        # dump to file
+        with open(output_file, 'w') as f:
+            json.dump({ 'programs': output_programs }, f, indent=2)
 
-    # for each program, check if there's a matching one in the provided JSON
-    # (there HAS to be one if the program was tested on)
-    with open(args.predict_asts_output) as f:
-        testing_corpus = json.load(f)
-    matches = []
-    found = 0
-    for i, program in enumerate(programs):
-        print('Matches found for {}/{} programs'.format(found, i), end='\r')
-        matched_program = match(program, testing_corpus)
-        if matched_program is not None:
-            matches.append(matched_program)
-            found += 1
-    print('Matches found for {}/{} programs'.format(found, i))
 
-    # do the top-k
-    output_programs = sorted(matches, key=lambda p: -p['corpus_dist'])[:args.k]
+# canonical hash of an AST, equal for ASTs that are equal as dicts
+def ast_key(ast):
+    return hashlib.sha1(json.dumps(ast, sort_keys=True).encode('utf-8')).digest()
 
-    # dump to file
-    with open(args.output_file, 'w') as f:
-        json.dump({ 'programs': output_programs }, f, indent=2)
 
-def match(program, testing_corpus):
-    for testing_program in testing_corpus['programs']:
-        if testing_program['original_ast'] == program['ast']:
-            testing_program['corpus_dist'] = program['corpus_dist']
-            return testing_program
-    return None
+# index the (first) program with each of the given original ASTs in a predict_asts output, reading it as a stream
+def build_index(predict_asts_output, keys):
+    index = {}
+    for testing_program in read_programs(predict_asts_output):
+        key = ast_key(testing_program['original_ast'])
+        if key in keys and key not in index:
+            index[key] = testing_program
+    return index
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('testing_with_dists', type=str, nargs=1,
                        help='input file, the testing data with distances')
-    parser.add_argument('--predict_asts_output', type=str, required=True,
-                       help='data file containing output from predict_asts (variational-*, encdec-*.json)')
-    parser.add_argument('--output_file', type=str, required=True,
-                       help='output file to print to')
+    parser.add_argument('--predict_asts_output', type=str, nargs='+', required=True,
+                       help='data files containing output from predict_asts (variational-*, encdec-*.json)')
+    parser.add_argument('--output_file', type=str, nargs='+', required=True,
+                       help='output files to print to, one for each predict_asts output')
     parser.add_argument('--k', type=int, required=True,
-                        help='the top-K (NOTE: the actual number, not top-K%). Find this using other means.')
+                        help='the top-K (NOTE: the actual number, not top-K%%). Find this using other means.')
     args = parser.parse_args()
     extract_topk(args)
@@ -12,74 +12,157 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from __future__ import print_function
 import tensorflow as tf
 import argparse
 import json
+import os
 import time
 
 import bayou.core.infer
 import bayou.experiments.nonbayesian.infer
 import bayou.experiments.low_level_evidences.infer
 import bayou.experiments.low_level_sketches.infer
+from bayou.core.programs import read_programs, parallel_map
 
 TIMEOUT = 20  # seconds per query
+INDEX = 'index'  # position of each program in the input file, in the JSON-lines output
+
+# Predicts ASTs for the programs in the input file with --num_workers processes (each with its own model), writing
+# every program to a JSON-lines file as soon as it is done. If the output file already exists, the programs in it are
+# not predicted again, so an interrupted run can be resumed. If the output is a .json file, the JSON-lines file is
+# <output_file>.partial.jsonl, from which the .json file is written (in the order of the input) at the end.
+# Programs in a .jsonl output are in the order they were done, and keep their position in the input file as the
+# "index" field, which resuming relies on (the .json output is in the order of the input, without it).
 
 
 def main(clargs):
-    with open(clargs.input_file[0]) as f:
-        js = json.load(f)
-    programs = js['programs']
-
-    with tf.Session() as sess:
-        if clargs.model == 'bayesian':
-            p_type = bayou.core.infer.BayesianPredictor
-        elif clargs.model == 'nonbayesian':
-            p_type = bayou.experiments.nonbayesian.infer.NonBayesianPredictor
-        elif clargs.model == 'low_level_evidences':
-            p_type = bayou.experiments.low_level_evidences.infer.BayesianPredictor
-        elif clargs.model == 'low_level_sketches':
-            p_type = bayou.experiments.low_level_sketches.infer.BayesianPredictor
-        else:
-            raise TypeError('invalid type of model specified')
-        print('Loading model...')
-        predictor = p_type(clargs.save, sess)
-
-        for i, program in enumerate(programs):
-            start = time.time()
-            if not clargs.evidence == 'all':
-                if program[clargs.evidence] is []:
-                    program['out_asts'] = []
-                    print('Program {}, {} ASTs, {:.2f}s'.format(
-                        i, len(program['out_asts']), time.time() - start))
-                    continue
-                evidences = {clargs.evidence: program[clargs.evidence]}
+    if clargs.output_file is None:
+        progress_file = None
+    elif clargs.output_file.endswith('.jsonl'):
+        progress_file = clargs.output_file
+    else:
+        progress_file = clargs.output_file + '.partial.jsonl'
+    finished = read_finished(progress_file) if progress_file is not None else {}
+    total = sum(1 for _ in read_programs(clargs.input_file[0]))
+    todo = total - len(finished)
+    print('{} programs, {} already done'.format(total, len(finished)))
+
+    programs = ((i, program) for i, program in enumerate(read_programs(clargs.input_file[0])) if i not in finished)
+    out = open(progress_file, 'a') if progress_file is not None else None
+    start = time.time()
+    try:
+        results = parallel_map(predict, programs, clargs.num_workers, initializer=load_predictor,
+                               initargs=(clargs,), ordered=False)
+        for done, (i, program, elapsed) in enumerate(results, 1):
+            program[INDEX] = i
+            if out is not None:
+                out.write(json.dumps(program) + '\n')
+                out.flush()
             else:
-                evidences = program
-            asts, counts = [], []
-            for j in range(100):
-                if time.time() - start > TIMEOUT:
-                    break
-                try:
-                    ast = predictor.infer(evidences)
-                except AssertionError:
-                    continue
-                try:
-                    counts[asts.index(ast)] += 1
-                except ValueError:
-                    asts.append(ast)
-                    counts.append(1)
-            for ast, count in zip(asts, counts):
-                ast['count'] = count
-            asts.sort(key=lambda x: x['count'], reverse=True)
-            program['out_asts'] = asts[:10]
-            print('Program {}, {} ASTs, {:.2f}s'.format(
-                i, len(program['out_asts']), time.time() - start))
-
-        if clargs.output_file is None:
-            print(json.dumps({'programs': programs}, indent=2))
-        else:
-            with open(clargs.output_file, 'w') as f:
-                json.dump({'programs': programs}, f, indent=2)
+                finished[i] = program
+            rate = done / (time.time() - start)
+            print('Program {}, {} ASTs, {:.2f}s ({}/{} done, {:.2f} programs/s, ETA {})'.format(
+                i, len(program['out_asts']), elapsed, done, todo, rate, format_time((todo - done) / rate)))
+    finally:
+        if out is not None:
+            out.close()
+
+    if progress_file is None:
+        print(json.dumps({'programs': sorted_programs(finished.values())}, indent=2))
+    elif progress_file != clargs.output_file:
+        programs = sorted_programs(read_finished(progress_file).values())
+        with open(clargs.output_file, 'w') as f:
+            json.dump({'programs': programs}, f, indent=2)
+        os.remove(progress_file)
+
+
+# the programs (by index) in a JSON-lines output file. A line that was not completely written (if the run was
+# interrupted) is removed from the file, so that new programs can be appended to it.
+def read_finished(progress_file):
+    finished, end = {}, 0
+    if not os.path.exists(progress_file):
+        return finished
+    with open(progress_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                program = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            finished[program[INDEX]] = program
+            end += len(line)
+    with open(progress_file, 'r+') as f:
+        f.truncate(end)
+    return finished
+
+
+def sorted_programs(programs):
+    programs = sorted(programs, key=lambda program: program[INDEX])
+    for program in programs:
+        del program[INDEX]
+    return programs
+
+
+def format_time(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+_predictor, _evidence = None, None  # the model of each worker process, and the evidence to use
+
+
+def load_predictor(clargs):
+    global _predictor, _evidence
+    if clargs.model == 'bayesian':
+        p_type = bayou.core.infer.BayesianPredictor
+    elif clargs.model == 'nonbayesian':
+        p_type = bayou.experiments.nonbayesian.infer.NonBayesianPredictor
+    elif clargs.model == 'low_level_evidences':
+        p_type = bayou.experiments.low_level_evidences.infer.BayesianPredictor
+    elif clargs.model == 'low_level_sketches':
+        p_type = bayou.experiments.low_level_sketches.infer.BayesianPredictor
+    else:
+        raise TypeError('invalid type of model specified')
+    print('Loading model...')
+    # open for the lifetime of the process. Several workers share the GPU, so none may claim all its memory
+    config = tf.ConfigProto(gpu_options=tf.GPUOptions(allow_growth=True)) if clargs.num_workers > 1 else None
+    sess = tf.Session(config=config)
+    _predictor = p_type(clargs.save, sess)
+    _evidence = clargs.evidence
+
+
+def predict(item):
+    i, program = item
+    predictor = _predictor
+    start = time.time()
+    if not _evidence == 'all':
+        if program[_evidence] is []:
+            program['out_asts'] = []
+            return i, program, time.time() - start
+        evidences = {_evidence: program[_evidence]}
+    else:
+        evidences = program
+    asts, counts = [], []
+    for j in range(100):
+        if time.time() - start > TIMEOUT:
+            break
+        try:
+            ast = predictor.infer(evidences)
+        except AssertionError:
+            continue
+        try:
+            counts[asts.index(ast)] += 1
+        except ValueError:
+            asts.append(ast)
+            counts.append(1)
+    for ast, count in zip(asts, counts):
+        ast['count'] = count
+    asts.sort(key=lambda x: x['count'], reverse=True)
+    program['out_asts'] = asts[:10]
+    return i, program, time.time() - start
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -94,7 +177,11 @@ if __name__ == '__main__':
                         choices=['apicalls', 'types', 'context', 'all'],
                         help='use only this evidence for inference queries')
     parser.add_argument('--output_file', type=str, default=None,
-                        help='output file to print predicted ASTs')
+                        help='output file to print predicted ASTs (JSON-lines if it ends with .jsonl, in which '
+                             'each program has its position in the input file as "index")')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes to predict with, each with its own copy of the model (sharing '
+                             'the GPU, if any: the model must fit in its memory this many times)')
     clargs = parser.parse_args()
     print(clargs)
     main(clargs)
@@ -17,32 +17,97 @@ import zss
 import re
 import json
 import argparse
+import collections
+import functools
+import numpy as np
 import editdistance
 
-# WARNING: This experiment might take a long time. Make sure the data is split
-# and the execution of this script is parallelized. Use split.py (and later
-# merge.py) for this purpose.
+from bayou.core.programs import read_programs, parallel_map
+
+# Finds the closest program in the corpus by tree edit distance for every test program. Most of the corpus is pruned
+# with a lower bound on the distance, and the test programs are processed in parallel with --num_workers processes.
 
 
 def editdist(clargs):
     with open(clargs.input_file[0]) as f:
         js = json.load(f)
-    with open(clargs.corpus) as f:
-        corpus = json.load(f)
-    for i, program in enumerate(js['programs']):
-        program['corpus_dist'] = int(closest_dist(program['ast'], corpus))
+    asts = [program['ast'] for program in js['programs']]
+    dists = parallel_map(closest_dist, asts, clargs.num_workers, initializer=load_corpus, initargs=(clargs.corpus,))
+    for i, (program, dist) in enumerate(zip(js['programs'], dists)):
+        program['corpus_dist'] = int(dist)
         print('Done with {} programs'.format(i))
     with open(clargs.output_file, 'w') as f:
         json.dump(js, f, indent=2)
 
 
-def closest_dist(ast, corpus):
-    dists = [zss.simple_distance(ast, program['ast'],
-                                 get_children=ZSS.get_children,
-                                 get_label=ZSS.get_label,
-                                 label_dist=ZSS.label_dist_string)
-             for program in corpus['programs']]
-    return min(dists)
+_corpus = None  # the corpus of each worker process
+
+
+def load_corpus(corpus_file):
+    global _corpus
+    _corpus = Corpus(program['ast'] for program in read_programs(corpus_file))
+
+
+def closest_dist(ast):
+    return _corpus.closest_dist(ast)
+
+
+class Corpus(object):
+    """The ASTs of a corpus, converted once to zss trees and indexed by their labels.
+
+    For a tree with n1 nodes and one with n2 nodes that have c labels in common (as multisets), every node
+    that is not mapped to a node with the same label costs at least 1 to delete, insert or relabel, so their
+    distance is at least max(n1, n2) - c (which is also at least the difference in size). The candidates are
+    compared in increasing order of this bound, until it is no less than the closest distance found."""
+
+    def __init__(self, asts):
+        self.labels = {}
+        self.trees, sizes, postings = [], [], collections.defaultdict(lambda: ([], []))
+        for i, ast in enumerate(asts):
+            tree, labels = to_tree(ast)
+            self.trees.append(tree)
+            sizes.append(len(labels))
+            for label, count in collections.Counter(self.labels.setdefault(label, len(self.labels))
+                                                    for label in labels).items():
+                postings[label][0].append(i)
+                postings[label][1].append(count)
+        self.sizes = np.array(sizes, dtype=np.int64)
+        # the trees with each label, and the number of nodes with the label in each of them
+        self.postings = {label: (np.array(trees, dtype=np.int64), np.array(counts, dtype=np.int64))
+                         for label, (trees, counts) in postings.items()}
+
+    def lower_bounds(self, labels):
+        common = np.zeros(len(self.trees), dtype=np.int64)
+        for label, count in collections.Counter(labels).items():
+            if label in self.labels:
+                trees, counts = self.postings[self.labels[label]]
+                common[trees] += np.minimum(counts, count)
+        return np.maximum(self.sizes, len(labels)) - common
+
+    def closest_dist(self, ast):
+        tree, labels = to_tree(ast)
+        bounds = self.lower_bounds(labels)
+        best = np.inf
+        for i in np.argsort(bounds, kind='mergesort'):
+            if bounds[i] >= best:
+                break
+            best = min(best, zss.simple_distance(tree, self.trees[i], label_dist=label_dist))
+        return best
+
+
+# convert an AST to a zss tree, returning it with the labels of all its nodes
+def to_tree(js):
+    labels = []
+
+    def convert(node):
+        labels.append(ZSS.get_label(node))
+        return zss.Node(labels[-1], [convert(child) for child in ZSS.get_children(node)])
+    return convert(js), labels
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def label_dist(label1, label2):
+    return ZSS.label_dist_string(label1, label2)
 
 
 class ZSS(object):
@@ -101,5 +166,7 @@ if __name__ == '__main__':
                         help='the training data file')
     parser.add_argument('--output_file', type=str, required=True,
                         help='output file to print to')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of processes to compute the distances with')
     clargs = parser.parse_args()
     editdist(clargs)
@@ -46,17 +46,39 @@ class LDA():
         data = [';'.join(bow) for bow in docs]
         vect = self.vectorizer.fit_transform(data)
         self.model.fit(vect)
+        self.normalize()
+
+    def normalize(self):
         # normalizing does not change subsequent inference, provided no further training is done
         self.model.components_ /= self.model.components_.sum(axis=1)[:, np.newaxis]
 
+    def fit_vocab(self, docs):
+        """Fit the vectorizer on an iterable of documents, which is iterated over only once"""
+        self.vectorizer.fit(';'.join(bow) for bow in docs)
+
+    def vectorize(self, docs):
+        return self.vectorizer.transform([';'.join(bow) for bow in docs])
+
+    def online(self, total_samples, batch_size, n_jobs=1, mass=None):
+        """Switch to online (minibatch) variational Bayes, to train on one minibatch at a time with partial_train.
+        When warm-starting from a saved model, its (normalized) topics are scaled back up to the given mass (the
+        sum of the vectorized corpus), otherwise the first minibatches would swamp them."""
+        self.model.set_params(learning_method='online', total_samples=total_samples, batch_size=batch_size,
+                              n_jobs=n_jobs, verbose=0)
+        if mass is not None:
+            self.model.components_ *= mass / len(self.model.components_)
+
+    def partial_train(self, vect):
+        self.model.partial_fit(vect)
+
     def infer(self, docs):
+        """Topic distribution of each document, as a (documents x topics) array"""
         data = [';'.join(bow) for bow in docs]
         vect = self.vectorizer.transform(data)
-        dist = self.model.transform(vect)
-        assert vect.shape[0] == dist.shape[0]
-
-        # NOTE: if a document is empty, this method returns a zero topic-dist vector
-        samples = [list(doc_topic_dist) if m.nnz > 0 else ([0.] * self.model.n_topics)
-                   for m, doc_topic_dist in zip(vect, dist)]
-        return samples
 
+        # NOTE: if a document is empty, its topic-dist vector is zero (and it does not go through the E-step)
+        nonempty = vect.getnnz(axis=1) > 0
+        dist = np.zeros((vect.shape[0], self.model.components_.shape[0]))
+        if np.any(nonempty):
+            dist[nonempty] = self.model.transform(vect[nonempty])
+        return dist
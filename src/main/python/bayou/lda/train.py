@@ -15,26 +15,39 @@
 from __future__ import print_function
 import os
 import sys
-import json
 import pickle
 import argparse
 
 from bayou.lda.model import LDA
+from bayou.core.programs import read_programs, chunks
 
 
 def train(clargs):
-    print('Reading data file...')
-    data = get_data(clargs.input_file[0], clargs.evidence)
+    if clargs.warm_start is not None and not clargs.online:
+        raise ValueError('--warm_start requires --online')
+    if clargs.warm_start is not None and len(clargs.ntopics) > 1:
+        raise ValueError('Cannot sweep over several --ntopics when warm-starting from a model')
+    if not clargs.online:
+        print('Reading data file...')
+        data = get_data(clargs.input_file[0], clargs.evidence)
 
     ok = 'r'
     while ok == 'r':
-        model = LDA(args=clargs)
-        model.train(data)
-        top_words = model.top_words(clargs.top)
-        for i, words in enumerate(top_words):
-            print('\nTop words in Topic#{:d}'.format(i))
-            for w in words:
-                print('{:.2f} {:s}'.format(words[w], w))
+        if clargs.online:
+            models = train_online(clargs)
+        else:
+            models = []
+            for ntopics in clargs.ntopics:
+                model = LDA(args=argparse.Namespace(ntopics=ntopics, alpha=clargs.alpha))
+                model.model.set_params(n_jobs=clargs.num_workers)
+                model.train(data)
+                models.append(model)
+        for ntopics, model in zip(clargs.ntopics, models):
+            top_words = model.top_words(clargs.top)
+            for i, words in enumerate(top_words):
+                print('\nTop words in Topic#{:d} (of {:d})'.format(i, ntopics))
+                for w in words:
+                    print('{:.2f} {:s}'.format(words[w], w))
         if clargs.confirm:
             print('\nOK with the model (y(es)/n(o)/r(edo))? ', end='')
             ok = sys.stdin.readline().rstrip('\n')
@@ -42,21 +55,75 @@ def train(clargs):
             ok = 'y'
 
     if ok == 'y':
-        print('Saving model to {:s}'.format(os.path.join(clargs.save, 'model.pkl')))
-        with open(os.path.join(clargs.save, 'model.pkl'), 'wb') as fmodel:
-            pickle.dump((model.model, model.vectorizer), fmodel)
+        for ntopics, model in zip(clargs.ntopics, models):
+            # a sweep saves each model in its own sub-directory
+            save_dir = clargs.save if len(models) == 1 else os.path.join(clargs.save, 'ntopics-{:d}'.format(ntopics))
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir)
+            print('Saving model to {:s}'.format(os.path.join(save_dir, 'model.pkl')))
+            with open(os.path.join(save_dir, 'model.pkl'), 'wb') as fmodel:
+                pickle.dump((model.model, model.vectorizer), fmodel)
+
+
+# Train with online variational Bayes on minibatches streamed from the input file, so that the data is never held in
+# memory. Each minibatch is vectorized once and used to update the models for all topic counts, and the E-step of
+# each update runs on num_workers cores. The first pass over the data builds the vocabulary (or, when warm-starting,
+# measures the new data), and the following ones train.
+def train_online(clargs):
+    ndocs, mass = 0, None
+
+    def docs():
+        nonlocal ndocs
+        ndocs = 0
+        for bow in get_docs(clargs.input_file[0], clargs.evidence):
+            ndocs += 1
+            yield bow
+
+    if clargs.warm_start is not None:
+        models = [LDA(from_file=clargs.warm_start)]
+        clargs.ntopics = [len(models[0].model.components_)]
+        print('Measuring data for LDA...')
+        mass = sum(models[0].vectorize(batch).sum() for batch in chunks(docs(), clargs.batch_size))
+    else:
+        models = [LDA(args=argparse.Namespace(ntopics=ntopics, alpha=clargs.alpha)) for ntopics in clargs.ntopics]
+        print('Building vocabulary for LDA...')
+        models[0].fit_vocab(docs())
+        for model in models[1:]:
+            model.vectorizer = models[0].vectorizer
+    if ndocs == 0:
+        raise ValueError('No programs in {}'.format(clargs.input_file[0]))
+    for model in models:
+        model.online(ndocs, clargs.batch_size, clargs.num_workers, mass=mass)
+
+    for p in range(clargs.passes):
+        done = 0
+        for batch in chunks(get_docs(clargs.input_file[0], clargs.evidence), clargs.batch_size):
+            vect = models[0].vectorize(batch)
+            done += len(batch)
+            if done == ndocs:  # score the last minibatch before training on it
+                perplexity = [model.model.perplexity(vect) for model in models]
+            for model in models:
+                model.partial_train(vect)
+            print('Pass {:d}/{:d}: {:d}/{:d} programs'.format(p + 1, clargs.passes, done, ndocs), end='\r')
+        print()
+        for ntopics, perp in zip(clargs.ntopics, perplexity):
+            print('Perplexity of {:d} topics on the last minibatch: {:.2f}'.format(ntopics, perp))
+
+    for model in models:
+        model.normalize()
+    return models
+
+
+def get_docs(input_file, evidence):
+    for program in read_programs(input_file):
+        yield set(program[evidence])
 
 
 def get_data(input_file, evidence):
-    with open(input_file) as f:
-        js = json.loads(f.read())
     data = []
-    nprograms = len(js['programs'])
-
-    for i, program in enumerate(js['programs']):
-        bow = set(program[evidence])
+    for i, bow in enumerate(get_docs(input_file, evidence)):
         data.append(bow)
-        print('Gathering data for LDA: {:5d}/{:d} programs'.format(i+1, nprograms), end='\r')
+        print('Gathering data for LDA: {:5d} programs'.format(i+1), end='\r')
     print()
     return data
 
@@ -64,9 +131,10 @@ def get_data(input_file, evidence):
 if __name__ == '__main__':
     argparser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     argparser.add_argument('input_file', type=str, nargs=1,
-                           help='input JSON file')
-    argparser.add_argument('--ntopics', type=int, required=True,
-                           help='run LDA with n topics')
+                           help='input JSON file (or JSON-lines file, one program per line, if it ends with .jsonl)')
+    argparser.add_argument('--ntopics', type=int, nargs='+', required=True,
+                           help='run LDA with n topics (several values sweep over them, saving each model in a '
+                                'sub-directory of --save)')
     argparser.add_argument('--evidence', choices=['apicalls', 'types', 'context'], required=True,
                            help='the type of evidence for which LDA is run')
     argparser.add_argument('--save', type=str, default='save',
@@ -77,5 +145,17 @@ if __name__ == '__main__':
                            help='top-k words to print from each topic')
     argparser.add_argument('--confirm', action='store_true',
                            help='confirm topics before saving')
+    argparser.add_argument('--online', action='store_true',
+                           help='train with online (minibatch) variational Bayes, streaming the data from the file')
+    argparser.add_argument('--batch_size', type=int, default=4096,
+                           help='number of programs in a minibatch (online training)')
+    argparser.add_argument('--passes', type=int, default=1,
+                           help='number of passes over the data (online training)')
+    argparser.add_argument('--warm_start', type=str, default=None,
+                           help='continue training this model.pkl on the data (online training)')
+    argparser.add_argument('--num_workers', type=int, default=1,
+                           help='number of processes running the E-step (-1 for all cores)')
     clargs = argparser.parse_args()
+    if clargs.passes < 1:
+        argparser.error('--passes must be at least 1')
     train(clargs)
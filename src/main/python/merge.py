@@ -15,28 +15,33 @@
 from __future__ import print_function
 
 # Use this script to merge data files in a folder (the opposite of split.py).
-# The script will accept a folder containing all the JSON files, and it will
-# merge them into a given file.
+# The script will accept a folder containing all the JSON (or JSON-lines) files,
+# and it will merge them into a given file. Programs are streamed one at a time,
+# so the data is never held in memory.
 
 import os
-import json
 import argparse
 
+from bayou.core.programs import read_programs, ProgramWriter, PARTIAL
+
 
 def merge(clargs):
-    programs = []
-    for filename in sorted(os.listdir(clargs.folder[0])):
-        with open(os.path.join(clargs.folder[0], filename)) as f:
-            js = json.load(f)
-        programs += (js['programs'])
-    with open(clargs.output_file, 'w') as f:
-        json.dump({'programs': programs}, f, indent=2)
+    # list the files before the output is created, as it may be in the folder, and skip files being written
+    output = os.path.abspath(clargs.output_file)
+    filenames = [os.path.join(clargs.folder[0], filename) for filename in sorted(os.listdir(clargs.folder[0]))
+                 if not filename.endswith(PARTIAL)]
+    filenames = [filename for filename in filenames if os.path.abspath(filename) != output]
+    with ProgramWriter(clargs.output_file) as writer:
+        for filename in filenames:
+            for program in read_programs(filename):
+                writer.write(program)
+    print('Merged {} programs'.format(writer.count))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('folder', type=str, nargs=1,
                         help='folder where all JSON files are stored')
     parser.add_argument('--output_file', type=str, required=True,
-                        help='file to output merged data')
+                        help='file to output merged data (in JSON-lines format if it ends with .jsonl)')
     clargs = parser.parse_args()
     merge(clargs)
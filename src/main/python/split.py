@@ -16,28 +16,55 @@ from __future__ import print_function
 
 # Use this script to split data between N processes. The script will accept a
 # JSON file containing the data (such as DATA-testing.json, variational-*.json,
-# etc.) and split it into N files
+# etc.) and split it into N files. Programs are streamed one at a time, so the
+# data is never held in memory.
 
+import os
 import json
 import math
+import hashlib
 import argparse
 
+from bayou.core.programs import read_programs, ProgramWriter
+
 
 def split(args):
-    with open(args.input_file[0]) as f:
-        js = json.load(f)
-    programs = js['programs']
-    n = int(math.ceil(float(len(programs)) / args.splits))
-    split_programs = [programs[i*n:i*n+n] for i in range(args.splits)]
-    for i, programs in enumerate(split_programs):
-        with open('{}-{}.json'.format(args.input_file[0][:-5], i), 'w') as f:
-            json.dump({'programs': programs}, f, indent=2)
+    base, ext = os.path.splitext(args.input_file[0])
+    ext = '.' + args.format if args.format is not None else ext
+    if args.key is None:
+        # contiguous blocks of programs, as evenly sized as possible
+        count = sum(1 for _ in read_programs(args.input_file[0]))
+        n = max(int(math.ceil(float(count) / args.splits)), 1)
+
+    writers = [ProgramWriter('{}-{}{}'.format(base, i, ext)) for i in range(args.splits)]
+    try:
+        for i, program in enumerate(read_programs(args.input_file[0])):
+            shard = i // n if args.key is None else shard_of(program, args.key, args.splits)
+            writers[shard].write(program)
+    except BaseException:  # leave the splits unfinished, rather than complete-looking but truncated
+        for writer in writers:
+            writer.abort()
+        raise
+    for writer in writers:
+        writer.close()
+    print('Split into {} files: {}'.format(args.splits, ', '.join(str(writer.count) for writer in writers)))
+
+
+# stable shard of a program, from a hash of the value of its key (the same in every run and on every machine)
+def shard_of(program, key, splits):
+    value = json.dumps(program[key], sort_keys=True, separators=(',', ':'))
+    return int(hashlib.sha1(value.encode('utf-8')).hexdigest(), 16) % splits
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('input_file', type=str, nargs=1,
-                        help='input JSON file')
+                        help='input JSON file (or JSON-lines file, if it ends with .jsonl)')
     parser.add_argument('--splits', type=int, required=True,
                         help='number of splits')
+    parser.add_argument('--key', type=str, default=None,
+                        help='split by a hash of this field of the programs (e.g., "file" or "ast"), instead of '
+                             'into contiguous blocks')
+    parser.add_argument('--format', type=str, choices=['json', 'jsonl'], default=None,
+                        help='format of the output files (by default, the same as the input file)')
     args = parser.parse_args()
     split(args)
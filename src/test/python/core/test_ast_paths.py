@@ -0,0 +1,88 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+import pytest
+
+pytest.importorskip('tensorflow')  # bayou.core.utils builds TensorFlow graphs
+from bayou.core.utils import ast_paths, pad_paths, CHILD_EDGE, SIBLING_EDGE
+
+
+# the recursive definition of the paths that ast_paths enumerates iteratively
+def reference_paths(js, idx=0):
+    cons_calls = []
+    i = idx
+    while i < len(js) and js[i]['node'] == 'DAPICall':
+        cons_calls.append((js[i]['_call'], SIBLING_EDGE))
+        i += 1
+    if i == len(js):
+        return [cons_calls + [('STOP', SIBLING_EDGE)]]
+    node_type = js[i]['node']
+    ph = [cons_calls + [(node_type, SIBLING_EDGE)] + path for path in reference_paths(js, i + 1)]
+    if node_type == 'DBranch':
+        pC = reference_paths(js[i]['_cond'])
+        p1, p2 = reference_paths(js[i]['_then']), reference_paths(js[i]['_else'])
+        pv = [cons_calls + [('DBranch', CHILD_EDGE)] + pC[0] + path for path in [p1[0] + p for p in p2] + p1[1:]]
+    elif node_type == 'DExcept':
+        p1, p2 = reference_paths(js[i]['_try']), reference_paths(js[i]['_catch'])
+        pv = [cons_calls + [('DExcept', CHILD_EDGE)] + path for path in [p1[0] + p for p in p2] + p1[1:]]
+    else:
+        pC = reference_paths(js[i]['_cond'])
+        pv = [cons_calls + [('DLoop', CHILD_EDGE)] + pC[0] + path for path in reference_paths(js[i]['_body'])]
+    return ph + pv
+
+
+def random_nodes(rng, depth):
+    def calls(n):
+        return [{'node': 'DAPICall', '_call': 'call{}'.format(rng.randrange(5))} for _ in range(n)]
+    nodes = []
+    for _ in range(rng.randrange(4)):
+        kind = rng.choice(['DAPICall', 'DAPICall', 'DBranch', 'DExcept', 'DLoop']) if depth > 0 else 'DAPICall'
+        if kind == 'DAPICall':
+            nodes += calls(1)
+        elif kind == 'DBranch':
+            nodes.append({'node': kind, '_cond': calls(rng.randrange(2)),
+                          '_then': random_nodes(rng, depth - 1), '_else': random_nodes(rng, depth - 1)})
+        elif kind == 'DExcept':
+            nodes.append({'node': kind, '_try': random_nodes(rng, depth - 1), '_catch': random_nodes(rng, depth - 1)})
+        else:
+            nodes.append({'node': kind, '_cond': calls(rng.randrange(2)), '_body': random_nodes(rng, depth - 1)})
+    return nodes
+
+
+def test_ast_paths_match_recursive_definition():
+    rng = random.Random(0)
+    for _ in range(300):
+        nodes = random_nodes(rng, 3)
+        expected = [[('DSubTree', CHILD_EDGE)] + path for path in reference_paths(nodes)]
+        max_depth = rng.choice([8, 16, 64])
+        vocab = []
+        if any(len(path) > max_depth for path in expected):
+            with pytest.raises(AssertionError):
+                ast_paths(nodes, max_depth, lambda name: vocab.append(name) or len(vocab))
+            continue
+        flat_n, flat_e, lengths = ast_paths(nodes, max_depth, lambda name: vocab.append(name) or len(vocab))
+
+        # vocab is called once per name, in order of appearance
+        names = [name for path in expected for name, _ in path]
+        assert vocab == list(dict.fromkeys(names))
+        assert lengths == [len(path) for path in expected]
+        assert [vocab[i - 1] for i in flat_n] == names
+        assert flat_e.tolist() == [edge == CHILD_EDGE for path in expected for _, edge in path]
+
+        n, e, padded_lengths = pad_paths([flat_n], [flat_e], [lengths], max_depth)
+        assert n.shape == (len(expected), max_depth)
+        for row, path in zip(n, expected):
+            assert [vocab[i - 1] for i in row[:len(path)]] == [name for name, _ in path]
+            assert not row[len(path):].any()
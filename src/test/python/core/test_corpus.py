@@ -0,0 +1,103 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pytest
+
+from bayou.core.corpus import CorpusWriter, Corpus, is_corpus, corpus_key, _encode_ast, _decode_ast, \
+    AST, LIST, TOKENS, EXTRA
+
+
+def call(name):
+    return {'node': 'DAPICall', '_call': name}
+
+
+AST_JS = {'node': 'DSubTree', '_nodes': [
+    call('a()'),
+    {'node': 'DBranch', '_cond': [call('c()')], '_then': [], '_else': [call('a()'), call('e()')]},
+    {'node': 'DExcept', '_try': [{'node': 'DLoop', '_cond': [], '_body': [call('b()')]}], '_catch': [call('x()')]},
+]}
+
+PROGRAMS = [
+    {'file': 'A.java', 'ast': AST_JS, 'apicalls': ['a', 'b'], 'javadoc': 'returns  the\tsum'},
+    {'file': 'B.java', 'ast': {'node': 'DSubTree', '_nodes': []}, 'apicalls': [], 'types': ['T']},
+    {'file': 'C.java', 'ast': {'node': 'DSubTree', '_nodes': [{'node': 'DSwitch', '_cases': []}]}},  # unknown node
+    {'file': 'D.java', 'ast': {'node': 'DSubTree', '_nodes': [call('a()')], 'calls': ['a()']}},  # extra AST field
+    {'file': 'E.java', 'apicalls': 'a', 'types': [1, 2], 'javadoc': ['not', 'text']},  # kinds conflicting
+    {'file': 'F.java', 'context': ['int'], 'extra': {'x': None}, 'a-b': ['c'], 'out_asts': [AST_JS]},
+]
+
+
+def write(path, programs):
+    with CorpusWriter(str(path)) as writer:
+        for program in programs:
+            writer.write(program)
+    return Corpus(str(path))
+
+
+def test_ast_round_trip():
+    strings = {}
+    tokens = []
+    _encode_ast(AST_JS, lambda s: strings.setdefault(s, len(strings)), tokens)
+    assert min(tokens) < -1 and tokens.count(-1) == 8  # one END per list of children
+    assert _decode_ast(tokens, list(strings)) == AST_JS
+    with pytest.raises(ValueError):
+        _encode_ast({'node': 'DSwitch'}, lambda s: 0, [])
+
+
+def test_round_trip(tmpdir):
+    corpus = write(tmpdir.join('corpus'), PROGRAMS)
+    assert len(corpus) == len(PROGRAMS)
+    expected = list(PROGRAMS)
+    expected[0] = dict(PROGRAMS[0], javadoc='returns the sum')  # only the words of a javadoc are kept
+    assert list(corpus) == expected
+    assert corpus.kinds == {EXTRA: 'json', 'ast': AST, 'apicalls': LIST, 'javadoc': TOKENS, 'types': LIST,
+                            'context': LIST}
+
+
+def test_random_access(tmpdir):
+    corpus = write(tmpdir.join('corpus'), PROGRAMS)
+    assert corpus[4] == PROGRAMS[4]
+    assert corpus[1]['types'] == ['T']
+    assert [corpus.strings[i] for i in corpus.ids('apicalls', 0)] == ['a', 'b']
+    assert len(corpus.ids('apicalls', 1)) == 0
+    assert corpus.ids('types', 0) is None  # before the column was first seen
+    assert corpus.ids('types', 4) is None  # not a list of strings, kept as JSON
+    assert corpus.ids('ast', 2) is None
+    with pytest.raises(IndexError):
+        corpus[len(PROGRAMS)]
+
+
+def test_empty(tmpdir):
+    corpus = write(tmpdir.join('corpus'), [])
+    assert len(corpus) == 0 and list(corpus) == []
+    assert write(tmpdir.join('corpus'), [{}])[0] == {}
+
+
+def test_rewrite_in_place(tmpdir):
+    path = tmpdir.join('corpus')
+    write(path, PROGRAMS[:1])
+    key = corpus_key(str(path))
+    assert list(write(path, PROGRAMS[1:3])) == PROGRAMS[1:3]
+    assert corpus_key(str(path)) != key
+
+
+def test_failed_write_is_not_a_corpus(tmpdir):
+    path = str(tmpdir.join('corpus'))
+    write(path, PROGRAMS)
+    with pytest.raises(KeyError):
+        with CorpusWriter(path) as writer:
+            writer.write(PROGRAMS[0])
+            raise KeyError()
+    assert os.path.isdir(path) and not is_corpus(path)
@@ -0,0 +1,51 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'contrib'):
+    pytest.skip('requires TensorFlow 1.x', allow_module_level=True)
+from bayou.core.evidence import Javadoc
+from bayou.core.utils import saved_variables
+
+
+def javadoc(order):
+    ev = Javadoc(order, max_length=12, filter_sizes=[2, 3, 4], num_filters=5)
+    ev.final_embedding = np.random.RandomState(0).rand(20, 8).astype(np.float32)
+    ev.final_embedding[0] = 0.
+    return ev
+
+
+def test_javadoc_embedding_shared_across_orders():
+    config = argparse.Namespace(latent_size=7)
+    with tf.Graph().as_default():
+        evidences = [javadoc('0'), javadoc('1')]
+        inputs = [ev.placeholder(config) for ev in evidences]
+        with tf.variable_scope('mean'):
+            encodings = [ev.encode(i, config) for ev, i in zip(evidences, inputs)]
+        embeddings = [var.op.name for var in tf.global_variables() if var.op.name.endswith('javadoc/embedding/W')]
+        assert embeddings == ['mean/javadoc/embedding/W']
+        # the embedding is rebuilt from embedding.npy rather than restored from checkpoints
+        assert not [var for var in saved_variables() if var.op.name in embeddings]
+        assert saved_variables()
+
+        # javadocs shorter than the longest filter, and batches shorter than max_length, are encoded
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            data = np.array([[3, 4, 0, 0, 0], [5, 6, 7, 8, 9]], dtype=np.int32)
+            for encoding, i in zip(encodings, inputs):
+                assert sess.run(encoding, {i: data}).shape == (2, 7)
@@ -0,0 +1,40 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import numpy as np
+
+from bayou.core.corpus import CorpusWriter
+from bayou.core.latent_index import LatentIndex, INDEX_PSI, INDEX_ASTS
+
+
+def test_nearest_matches_brute_force(tmpdir):
+    rng = np.random.RandomState(0)
+    psis = rng.randn(103, 8).astype(np.float32)
+    np.save(os.path.join(str(tmpdir), INDEX_PSI), psis)
+    with CorpusWriter(os.path.join(str(tmpdir), INDEX_ASTS)) as asts:
+        for i in range(len(psis)):
+            asts.write({'ast': {'node': 'DSubTree', '_nodes': [], 'id': i}, 'calls': ['c{}'.format(i)]})
+
+    queries = rng.randn(5, 8).astype(np.float32)
+    dist = np.sum(np.square(queries[:, np.newaxis] - psis[np.newaxis]), axis=2)
+    for block_size in [10, 64, 1000]:
+        index = LatentIndex(str(tmpdir), block_size=block_size)
+        idx, d = index.nearest(queries, k=7)
+        assert idx.tolist() == np.argsort(dist, axis=1)[:, :7].tolist()
+        assert np.allclose(d, np.sort(dist, axis=1)[:, :7], atol=1e-4)
+        retrieved = index.retrieve(queries[0], k=3)
+        assert [ast['id'] for ast in retrieved] == idx[0, :3].tolist()
+        assert [ast['calls'] for ast in retrieved] == [['c{}'.format(i)] for i in idx[0, :3]]
+    assert LatentIndex(str(tmpdir)).nearest(queries[0], k=500)[0].shape == (1, len(psis))
@@ -0,0 +1,95 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import pytest
+
+from bayou.core.corpus import CorpusWriter
+from bayou.core.programs import read_programs, ProgramWriter, chunks, parallel_map, PARTIAL
+
+PROGRAMS = [{'file': 'F{}.java'.format(i), 'apicalls': ['a'] * (i % 3), 'n': i * 1001, 'x': 1.5} for i in range(50)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 1 << 20])
+def test_read_json(tmpdir, chunk_size):
+    path = str(tmpdir.join('data.json'))
+    # keys before the programs, whose values mention them, are skipped
+    js = {'note': '"programs": [{"file": "no"}]', 'programs_old': [{}], 'count': 123456, 'programs': PROGRAMS,
+          'after': '}'}
+    for indent in [None, 2]:
+        with open(path, 'w') as f:
+            json.dump(js, f, indent=indent)
+        assert list(read_programs(path, chunk_size)) == PROGRAMS
+
+
+def test_read_malformed_json(tmpdir):
+    path = str(tmpdir.join('data.json'))
+    for text in ['{"other": []}', '{"programs": [{"n": 1}', '[]']:
+        with open(path, 'w') as f:
+            f.write(text)
+        with pytest.raises(AssertionError):
+            list(read_programs(path, 4))
+
+
+def test_read_jsonl(tmpdir):
+    path = str(tmpdir.join('data.jsonl'))
+    with open(path, 'w') as f:
+        f.write('\n'.join(json.dumps(program) for program in PROGRAMS) + '\n\n')
+    assert list(read_programs(path)) == PROGRAMS
+
+
+def test_read_corpus(tmpdir):
+    path = str(tmpdir.join('corpus'))
+    with CorpusWriter(path) as writer:
+        for program in PROGRAMS:
+            writer.write(program)
+    assert list(read_programs(path)) == PROGRAMS
+
+
+@pytest.mark.parametrize('name', ['out.json', 'out.jsonl'])
+def test_write(tmpdir, name):
+    path = str(tmpdir.join(name))
+    with ProgramWriter(path) as writer:
+        for program in PROGRAMS:
+            writer.write(program)
+    assert writer.count == len(PROGRAMS)
+    assert list(read_programs(path)) == PROGRAMS
+    assert not os.path.exists(path + PARTIAL)
+
+
+@pytest.mark.parametrize('name', ['out.json', 'out.jsonl'])
+def test_failed_write_is_not_finalized(tmpdir, name):
+    path = str(tmpdir.join(name))
+    with pytest.raises(KeyError):
+        with ProgramWriter(path) as writer:
+            writer.write(PROGRAMS[0])
+            raise KeyError()
+    assert not os.path.exists(path) and os.path.exists(path + PARTIAL)
+
+
+def test_chunks():
+    assert list(chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunks([], 3)) == []
+
+
+def square(x):
+    return x * x
+
+
+@pytest.mark.parametrize('num_workers', [1, 3])
+def test_parallel_map(num_workers):
+    expected = [x * x for x in range(40)]
+    assert list(parallel_map(square, iter(range(40)), num_workers)) == expected
+    assert sorted(parallel_map(square, iter(range(40)), num_workers, ordered=False)) == expected
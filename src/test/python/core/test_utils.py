@@ -0,0 +1,35 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')  # bayou.core.utils builds TensorFlow graphs
+from bayou.core.utils import pad, lookup_tokens
+
+
+def test_pad():
+    rows = [[3, 1], [], [4, 1, 5, 9], [2]]
+    flat = np.array([x for row in rows for x in row], dtype=np.int32)
+    padded = pad(flat, np.array([len(row) for row in rows]), 5)
+    assert padded.dtype == np.int32
+    assert padded.tolist() == [row + [0] * (5 - len(row)) for row in rows]
+
+
+def test_lookup_tokens():
+    vocab = {'a': 1, 'b': 2, 'c': 3}
+    tokens = ['c', 'a', 'c', 'b', 'a']
+    assert lookup_tokens(tokens, vocab).tolist() == [vocab[token] for token in tokens]
+    with pytest.raises(KeyError):
+        lookup_tokens(['d'], vocab)